@@ -0,0 +1,55 @@
+# compares tweet inserts per second for per-row commits and the batched writer.
+# usage: python -m benchmarks.bench_tweetdb [n]
+
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from streamer.tweetdb import TweetWriter
+
+
+def rows(n):
+    for i in range(n):
+        url = f"https://twitter.com/i/web/status/{i}"
+        yield f"tweet number {i} about artificial intelligence", url, "ai"
+
+
+def per_row_commit(path, n):
+    # the original TweetDB.add path: default journal, one commit per tweet
+    conn = sqlite3.connect(path)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tweets (id INTEGER PRIMARY KEY, url TEXT UNIQUE, tweet TEXT, tag TEXT, reaction TEXT default '')"
+    )
+    start = time.perf_counter()
+    for tweet, url, tag in rows(n):
+        conn.execute(
+            "INSERT INTO tweets (url, tweet, tag) VALUES (?, ?, ?)", (url, tweet, tag)
+        )
+        conn.commit()
+    elapsed = time.perf_counter() - start
+    conn.close()
+    return elapsed
+
+
+def batched_writer(path, n):
+    writer = TweetWriter(path).start()
+    start = time.perf_counter()
+    for tweet, url, tag in rows(n):
+        writer.add(tweet, url, tag)
+    writer.flush()
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return elapsed
+
+
+def main(n):
+    for name, bench in [("per-row commit", per_row_commit), ("writer", batched_writer)]:
+        with tempfile.TemporaryDirectory() as tmp:
+            elapsed = bench(os.path.join(tmp, "tweets.db"), n)
+        print(f"{name:>15}: {n / elapsed:10.0f} inserts/s ({elapsed:.2f}s for {n})")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,127 @@
+# dynamic micro-batching for the classifier service.
+
+import asyncio
+import time
+
+import glog as log
+from prometheus_client import Histogram
+
+BATCH_SIZE = Histogram(
+    "classifier_batch_size",
+    "Number of texts run through the model in a single batch.",
+    ["label"],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+QUEUE_WAIT = Histogram(
+    "classifier_queue_wait_seconds",
+    "Time a text spends queued before its batch starts running.",
+    ["label"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0),
+)
+
+
+class Batcher:
+    """Batcher gathers concurrent prediction requests for a single label and runs them
+    through the model together.  A batch is started once max_batch_size texts are queued
+    or max_wait_ms has passed since the first one arrived, whichever comes first.
+    predict_fn is a blocking callable taking a list of texts and returning one result per
+    text; it is run in executor (the loop's default when None) so the event loop keeps
+    serving requests.  Up to concurrency batches run at the same time."""
+
+    def __init__(
+        self,
+        label,
+        predict_fn,
+        max_batch_size=32,
+        max_wait_ms=5.0,
+        executor=None,
+        concurrency=1,
+    ):
+        self.label = label
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.executor = executor
+        self.slots = asyncio.Semaphore(concurrency)
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.running = set()
+        self.outstanding = 0  # texts queued or running
+
+    async def predict(self, texts):
+        """Queues texts for prediction and returns their results in order."""
+        loop = asyncio.get_running_loop()
+        now = time.monotonic()
+        futures = []
+        for text in texts:
+            future = loop.create_future()
+            self.queue.put_nowait((text, future, now))
+            futures.append(future)
+
+        if self.task is None or self.task.done():
+            self.task = loop.create_task(self._run())
+        self.outstanding += len(futures)
+        try:
+            return await asyncio.gather(*futures)
+        finally:
+            self.outstanding -= len(futures)
+
+    async def drain(self):
+        """Waits for everything queued and running to finish, then stops the batcher."""
+        while self.outstanding:
+            await asyncio.sleep(0.01)
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _collect(self):
+        """Waits for the next batch of queued requests."""
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # wait for a free slot first so requests keep piling into the next batch
+            # while every slot is busy
+            await self.slots.acquire()
+            batch = await self._collect()
+            # callers that went away while queued don't need a forward pass
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                self.slots.release()
+                continue
+            task = loop.create_task(self._run_batch(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _run_batch(self, batch):
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        for _, _, queued in batch:
+            QUEUE_WAIT.labels(self.label).observe(started - queued)
+        BATCH_SIZE.labels(self.label).observe(len(batch))
+
+        texts = [text for text, _, _ in batch]
+        try:
+            results = await loop.run_in_executor(self.executor, self.predict_fn, texts)
+        except Exception as e:
+            log.error(f"[{self.label}] batch of {len(texts)} failed: {e}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        finally:
+            self.slots.release()
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
@@ -0,0 +1,100 @@
+# bounded cache of classifier predictions.
+
+import collections
+import hashlib
+import re
+import time
+
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+_url_re = re.compile(r"https?://\S+")
+_space_re = re.compile(r"\s+")
+
+
+def normalize(text):
+    """Normalizes text so that copies differing only in links, case or whitespace
+    share a cache entry.  The tag models are uncased so this doesn't change scores
+    beyond what the shortened links contribute."""
+    text = _url_re.sub("", text)
+    text = _space_re.sub(" ", text)
+    return text.strip().lower()
+
+
+def text_hash(text):
+    return hashlib.blake2b(normalize(text).encode("utf-8"), digest_size=16).digest()
+
+
+class PredictionCache:
+    """PredictionCache holds up to max_entries prediction results keyed by label and
+    normalized text hash.  Entries expire ttl seconds after they were stored and the
+    least recently used entry is evicted when the cache is full."""
+
+    def __init__(self, max_entries=10000, ttl=3600, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, label, text):
+        """Returns the cached result for text under label, or None."""
+        key = (label, text_hash(text))
+        entry = self.entries.get(key)
+        if entry is not None:
+            expires, result = entry
+            if expires > self.clock():
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return result
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, label, text, result):
+        key = (label, text_hash(text))
+        self.entries[key] = (self.clock() + self.ttl, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, label=None):
+        """Drops every entry for label, or everything if label is None.  Call this
+        when a label's model is reloaded."""
+        if label is None:
+            self.entries.clear()
+            return
+        for key in [key for key in self.entries if key[0] == label]:
+            del self.entries[key]
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+class CacheCollector:
+    """CacheCollector exports a PredictionCache's stats to prometheus as <prefix>_hits,
+    <prefix>_misses and <prefix>_evictions counters and a <prefix>_entries gauge.
+    Register it with prometheus_client.REGISTRY.register."""
+
+    def __init__(self, prefix, cache):
+        self.prefix = prefix
+        self.cache = cache
+
+    def collect(self):
+        stats = self.cache.stats()
+        for stat in ("hits", "misses", "evictions"):
+            yield CounterMetricFamily(
+                f"{self.prefix}_{stat}", f"Prediction cache {stat}.", value=stats[stat]
+            )
+        yield GaugeMetricFamily(
+            f"{self.prefix}_entries",
+            "Prediction cache entries.",
+            value=stats["entries"],
+        )
@@ -1,28 +1,139 @@
 import aiohttp
 import asyncio
 import glog as log
-from aiohttp.client_exceptions import ClientConnectorError, ContentTypeError
+from aiohttp.client_exceptions import ClientError, ContentTypeError
 import urllib.parse
 
+from classifier.cache import PredictionCache
+from classifier.registry import VERSION_HEADER
 
-async def _request(method, url):
-    async with aiohttp.ClientSession() as session:
-        async with session.request(method, url) as response:
-            return await response.json()
+
+class ClassifierClient:
+    """ClassifierClient is a long-lived client for the classifier service.  It keeps a
+    keep-alive connection pool open, caps the number of in-flight requests, gives every
+    attempt a deadline and retries failed attempts with exponential backoff.  Identical
+    (label, text) requests that overlap in time share a single HTTP call, and results
+    are kept in a PredictionCache so repeated texts aren't re-scored.  Set cache_size to
+    0 to disable caching.
+
+    Cached results are keyed by the model version the service reports alongside each
+    prediction.  Once a response shows a label's model was swapped, results from the
+    old model are no longer used."""
+
+    def __init__(
+        self,
+        base_url="http://localhost:8000",
+        max_in_flight=16,
+        timeout=5.0,
+        retries=2,
+        backoff=0.25,
+        cache_size=10000,
+        cache_ttl=3600,
+    ):
+        self.base_url = base_url
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.session = None
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.pending = {}
+        self.versions = {}  # label -> latest model version the service reported
+        self.replaced = set()  # (label, version) of models the service swapped out
+        self.cache = PredictionCache(cache_size, cache_ttl) if cache_size else None
+
+    def _get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_in_flight, keepalive_timeout=60
+            )
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self.session
+
+    async def _request(self, method, url):
+        session = self._get_session()
+        async with self.semaphore:
+            async with session.request(method, url) as response:
+                return await response.json(), response.headers.get(VERSION_HEADER)
+
+    async def _request_with_retry(self, method, url):
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._request(method, url)
+            except ContentTypeError:
+                # the service answered, retrying won't change what it says
+                raise
+            except (ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise
+                log.info(f"Retrying {url} in {delay}s after error: {e!r}")
+                await asyncio.sleep(delay)
+                delay *= 2
+
+    async def _predict(self, label, text):
+        # text needs to be url encoded
+        quoted = urllib.parse.quote(text, safe="")  # safe='' so / is encoded
+        url = f"{self.base_url}/predict/{label}?text={quoted}"
+        version = None
+        try:
+            response, version = await self._request_with_retry("GET", url)
+        except (ClientError, asyncio.TimeoutError) as e:
+            response = repr(e)
+
+        if isinstance(response, list):
+            if self.cache is not None and self._set_version(label, version):
+                self.cache.put((label, version), text, response[0])
+            return response[0]
+        else:
+            log.info(f"Unexpected response while requesting {url}: {response}")
+            return None
+
+    def _set_version(self, label, version):
+        """Records the version a response came from.  Returns False if that model was
+        already swapped out, e.g. for a request it was still finishing."""
+        if (label, version) in self.replaced:
+            return False
+        old = self.versions.get(label)
+        if label in self.versions and version != old:
+            log.info(f"{label} model changed from {old} to {version}")
+            self.replaced.add((label, old))
+            self.cache.invalidate((label, old))
+        self.versions[label] = version
+        return True
+
+    async def predict(self, label, text):
+        """Predict whether a text is a match or not for a given label."""
+        if self.cache is not None:
+            result = self.cache.get((label, self.versions.get(label)), text)
+            if result is not None:
+                return result
+
+        key = (label, text)
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._predict(label, text))
+            self.pending[key] = future
+            future.add_done_callback(lambda _: self.pending.pop(key, None))
+        # shield so one caller giving up doesn't cancel the request for the others
+        return await asyncio.shield(future)
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+_default_client = None
 
 
 async def predict(label, text):
-    """Predict whether a text is a match or not for a given label."""
-    # text needs to be url encoded
-    text = urllib.parse.quote(text, safe="")  # safe='' so / is encoded
-    url = f"http://localhost:8000/predict/{label}?text={text}"
-    try:
-        response = await _request("GET", url)
-    except (ClientConnectorError, ContentTypeError) as e:
-        response = str(e)
-
-    if isinstance(response, list):
-        return response[0]
-    else:
-        log.info(f"Unexpected response while requesting {url}: {response}")
-        return None
+    """Predict whether a text is a match or not for a given label, using a shared
+    module-level client."""
+    global _default_client
+    if _default_client is None:
+        _default_client = ClassifierClient()
+    return await _default_client.predict(label, text)
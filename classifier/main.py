@@ -1,25 +1,112 @@
-import collections
-from fastapi import FastAPI
+import asyncio
+import functools
+import os
+from typing import List
+
+from fastapi import FastAPI, HTTPException, Response
 from transformers import pipeline
+from prometheus_client import REGISTRY
 from prometheus_fastapi_instrumentator import Instrumentator
 
+from classifier import onnxbackend
+from classifier.batcher import Batcher
+from classifier.cache import CacheCollector, PredictionCache
+from classifier.registry import VERSION_HEADER, ModelRegistry, Models
+from classifier import workers
+
 app = FastAPI()
 
-classifiers = {}
+# batching configuration, tune these for the hardware the service runs on.
+MAX_BATCH_SIZE = int(os.environ.get("CLASSIFIER_MAX_BATCH_SIZE", 32))
+MAX_WAIT_MS = float(os.environ.get("CLASSIFIER_MAX_WAIT_MS", 5))
+# set CLASSIFIER_CACHE_SIZE to 0 to disable the result cache.
+CACHE_SIZE = int(os.environ.get("CLASSIFIER_CACHE_SIZE", 10000))
+CACHE_TTL = float(os.environ.get("CLASSIFIER_CACHE_TTL", 3600))
+# "auto" serves a label from its quantized ONNX graph when one was exported,
+# "torch" always uses the PyTorch pipeline.
+BACKEND = os.environ.get("CLASSIFIER_BACKEND", "auto")
+# number of inference worker processes, 0 runs inference in the server process.
+WORKERS = int(os.environ.get("CLASSIFIER_WORKERS", 0))
+MODEL_ROOT = "./classifier/models"
+# how often to check MODEL_ROOT for new model versions, in seconds.
+WATCH_INTERVAL = float(os.environ.get("CLASSIFIER_WATCH_INTERVAL", 30))
+
+cache = PredictionCache(CACHE_SIZE, CACHE_TTL) if CACHE_SIZE else None
+if cache is not None:
+    REGISTRY.register(CacheCollector("classifier_cache", cache))
+
+
+def load_classifier(model_dir):
+    if BACKEND == "auto" and onnxbackend.available(model_dir):
+        return onnxbackend.OnnxClassifier(model_dir)
+    return pipeline("sentiment-analysis", model=model_dir)
+
+
+def build_local(model_dirs):
+    """Loads each model into this process, with a Batcher running it."""
+    batchers = {}
+    for label, model_dir in model_dirs.items():
+        classifier = load_classifier(model_dir)
+
+        def predict_fn(texts, classifier=classifier):
+            # the pipeline pads each batch to its longest text
+            return classifier(texts, batch_size=len(texts), truncation=True)
+
+        batchers[label] = Batcher(
+            label, predict_fn, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS
+        )
+    return Models(batchers)
 
 
-def get_classifier(label: str):
-    global classifiers
-    if label not in classifiers:
-        classifiers[label] = pipeline(
-            "sentiment-analysis", model=f"./classifier/models/{label}"
+def build_pool(model_dirs):
+    """Loads a new worker pool serving every model, with a Batcher per label.  The
+    workers are forked by Models.start, on the event loop's thread."""
+    pool = workers.WorkerPool(
+        MODEL_ROOT, WORKERS, use_onnx=BACKEND == "auto", labels=list(model_dirs)
+    )
+    pool.load()
+    batchers = {
+        label: Batcher(
+            label,
+            functools.partial(workers.predict, label),
+            max_batch_size=MAX_BATCH_SIZE,
+            max_wait_ms=MAX_WAIT_MS,
+            executor=pool.executor,
+            concurrency=WORKERS,
         )
-    return classifiers[label]
+        for label in model_dirs
+    }
+    return Models(batchers, close=pool.shutdown, start=pool.fork)
+
+
+# a worker pool forks once with every model loaded, so any new version means a new
+# pool.  in process, labels are swapped one at a time.
+registry = ModelRegistry(
+    MODEL_ROOT,
+    build_pool if WORKERS else build_local,
+    per_label=not WORKERS,
+    on_swap=cache.invalidate if cache is not None else None,
+    interval=WATCH_INTERVAL,
+)
+watcher = None
 
 
 @app.on_event("startup")
 async def startup():
+    global watcher
     Instrumentator().instrument(app).expose(app)
+    # load and warm every model up front so no request waits for one
+    await registry.load()
+    watcher = asyncio.create_task(registry.watch())
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if watcher is not None:
+        watcher.cancel()
+    for models in set(registry.models.values()):
+        if models.close is not None:
+            models.close()
 
 
 @app.get("/")
@@ -27,7 +114,36 @@ async def root():
     return {"message": "Hello world"}
 
 
+async def predict_texts(label, texts, response):
+    """Returns a prediction for each text, only running cache misses through the model.
+    The version of the model is returned in a header, so clients can key their own
+    caches by it."""
+    try:
+        batcher = registry.batcher(label)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"no model for {label}")
+    response.headers[VERSION_HEADER] = registry.versions[label]
+    if cache is None:
+        return await batcher.predict(texts)
+
+    results = [cache.get(label, text) for text in texts]
+    misses = [i for i, result in enumerate(results) if result is None]
+    if misses:
+        predicted = await batcher.predict([texts[i] for i in misses])
+        # if the model was swapped meanwhile, these are the old model's results
+        current = registry.batcher(label) is batcher
+        for i, result in zip(misses, predicted):
+            if current:
+                cache.put(label, texts[i], result)
+            results[i] = result
+    return results
+
+
 @app.get("/predict/{label}")
-async def predict(label: str, text: str):
-    classifier = get_classifier(label)
-    return classifier(text)
+async def predict(label: str, text: str, response: Response):
+    return await predict_texts(label, [text], response)
+
+
+@app.post("/predict_batch/{label}")
+async def predict_batch(label: str, texts: List[str], response: Response):
+    return await predict_texts(label, texts, response)
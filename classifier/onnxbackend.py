@@ -0,0 +1,146 @@
+# int8 ONNX export and ONNX Runtime inference for the tag models.
+
+import os
+import sys
+
+import glog as log
+import numpy as np
+from transformers import AutoConfig, AutoTokenizer
+
+try:
+    import onnxruntime as ort
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+except ImportError:
+    ort = None
+
+ONNX_FILENAME = "model.quant.onnx"
+BASE_TOKENIZER = "distilbert-base-uncased"
+
+
+def onnx_path(model_dir):
+    return os.path.join(model_dir, ONNX_FILENAME)
+
+
+def available(model_dir):
+    """Returns True if model_dir has a quantized ONNX graph that can be served."""
+    return ort is not None and os.path.exists(onnx_path(model_dir))
+
+
+def load_tokenizer(model_dir):
+    # older checkpoints were saved without their tokenizer
+    try:
+        return AutoTokenizer.from_pretrained(model_dir)
+    except (OSError, ValueError):
+        return AutoTokenizer.from_pretrained(BASE_TOKENIZER)
+
+
+def export(model, tokenizer, model_dir):
+    """Exports a sequence classification model to ONNX and writes an int8 dynamically
+    quantized copy next to the checkpoint in model_dir."""
+    import torch
+
+    fp32_path = os.path.join(model_dir, "model.onnx")
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    model.eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "logits": {0: "batch"},
+            },
+            opset_version=14,
+        )
+    quantize_dynamic(fp32_path, onnx_path(model_dir), weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+    log.info(f"Exported quantized ONNX model to {onnx_path(model_dir)}")
+
+
+class OnnxClassifier:
+    """OnnxClassifier runs a quantized tag model on ONNX Runtime.  Calling it returns
+    the same [{"label": ..., "score": ...}] results as a sentiment-analysis pipeline."""
+
+    def __init__(self, model_dir, intra_op_threads=0):
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            onnx_path(model_dir), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = load_tokenizer(model_dir)
+        self.id2label = AutoConfig.from_pretrained(model_dir).id2label
+
+    def __call__(self, texts, batch_size=None, truncation=True):
+        if isinstance(texts, str):
+            texts = [texts]
+        results = []
+        batch_size = batch_size or len(texts)
+        for start in range(0, len(texts), batch_size):
+            results.extend(self._predict(texts[start : start + batch_size], truncation))
+        return results
+
+    def _predict(self, texts, truncation):
+        encoded = self.tokenizer(
+            texts, padding=True, truncation=truncation, return_tensors="np"
+        )
+        feeds = {
+            name: value.astype(np.int64)
+            for name, value in encoded.items()
+            if name in self.input_names
+        }
+        logits = self.session.run(None, feeds)[0]
+        logits = logits - logits.max(axis=1, keepdims=True)
+        probs = np.exp(logits)
+        probs /= probs.sum(axis=1, keepdims=True)
+        best = probs.argmax(axis=1)
+        return [
+            {"label": self.id2label[int(i)], "score": float(p[i])}
+            for i, p in zip(best, probs)
+        ]
+
+
+def parity_check(model_dir, texts, tolerance=0.05, batch_size=64):
+    """Compares the ONNX model against the PyTorch pipeline on texts.  Raises an
+    AssertionError if any label differs or any score is off by more than tolerance."""
+    from transformers import pipeline
+
+    reference = pipeline(
+        "sentiment-analysis", model=model_dir, tokenizer=load_tokenizer(model_dir)
+    )
+    quantized = OnnxClassifier(model_dir)
+    expected = reference(texts, batch_size=batch_size, truncation=True)
+    actual = quantized(texts, batch_size=batch_size)
+
+    mismatched = 0
+    worst = 0.0
+    for text, e, a in zip(texts, expected, actual):
+        if e["label"] != a["label"]:
+            mismatched += 1
+            log.info(f"label mismatch {e} {a}: {text}")
+        worst = max(worst, abs(e["score"] - a["score"]))
+    log.info(
+        f"parity on {len(texts)} texts: {mismatched} label mismatches, "
+        f"max score difference {worst:.4f}"
+    )
+    assert mismatched == 0, f"{mismatched} labels differ from the PyTorch model"
+    assert worst <= tolerance, f"score difference {worst:.4f} exceeds {tolerance}"
+
+
+if __name__ == "__main__":
+    # python onnxbackend.py <tag>, checks models/<tag> against the held-out split
+    from classifier.train import get_dataset
+
+    try:
+        tag = sys.argv[1]
+    except IndexError:
+        print("Usage: python onnxbackend.py <tag>")
+        sys.exit(1)
+
+    dataset, _, _ = get_dataset(tag)
+    parity_check(f"models/{tag}", dataset["test"]["text"])
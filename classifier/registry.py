@@ -0,0 +1,201 @@
+# versioned model loading and hot-swapping for the classifier service.
+
+import asyncio
+import hashlib
+import os
+
+import glog as log
+
+# run through every new model before it serves traffic
+SMOKE_TEXTS = [
+    "New paper on large language models from DeepMind",
+    "good morning everyone",
+    "",
+    "a" * 2000,
+]
+# response header naming the version of the model that made a prediction
+VERSION_HEADER = "X-Model-Version"
+
+
+def labels(model_root):
+    """Returns the labels with a model under model_root, none if it doesn't exist
+    (yet).  Version directories (<label>@<version>, see train.publish) aren't labels
+    of their own."""
+    if not os.path.isdir(model_root):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(model_root)
+        if "@" not in name and os.path.isdir(os.path.join(model_root, name))
+    )
+
+
+def model_version(model_dir):
+    """Returns the version of the model in model_dir, or None if there is no complete
+    model there.  A link to a version directory is versioned by its target's name,
+    anything else by the names, sizes and modification times of its files.  The
+    service and rescore both use it, so stored scores can be matched to the model
+    being served."""
+    if not os.path.exists(os.path.join(model_dir, "config.json")):
+        return None
+    if os.path.islink(model_dir):
+        return os.path.basename(os.path.realpath(model_dir))
+    digest = hashlib.sha256()
+    for entry in sorted(os.scandir(model_dir), key=lambda entry: entry.name):
+        if entry.is_file():
+            stat = entry.stat()
+            digest.update(f"{entry.name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:12]
+
+
+class Models:
+    """Models is one loaded generation of models: a Batcher per label, a start
+    function run on the event loop's thread before they serve anything (e.g. to fork
+    worker processes), and a close function that frees whatever serves them once
+    they're retired."""
+
+    def __init__(self, batchers, close=None, start=None):
+        self.batchers = batchers
+        self.close = close
+        self.start = start
+
+
+class ModelRegistry:
+    """ModelRegistry keeps every label under model_root loaded and swaps in new
+    versions without dropping requests.
+
+    build is a blocking function taking {label: model dir} and returning the Models
+    serving them; it runs on a background thread.  With per_label, only the labels
+    whose version changed are built, otherwise (e.g. for a worker pool) a change to
+    any label rebuilds all of them.  New models have to answer SMOKE_TEXTS sensibly
+    before they're swapped in; the models they replace finish the requests they
+    already have and are then closed.  on_swap(label) is called after each swap, e.g.
+    to invalidate cached predictions, and when a label whose model directory was
+    deleted is retired.
+
+    Directories written in place are only loaded once their version is the same on
+    two scans in a row, so a model that's still being written isn't picked up."""
+
+    def __init__(self, model_root, build, per_label=True, on_swap=None, interval=30.0):
+        self.model_root = model_root
+        self.build = build
+        self.per_label = per_label
+        self.on_swap = on_swap
+        self.interval = interval
+        self.versions = {}  # label -> version being served
+        self.models = {}  # label -> Models serving it
+        self.rejected = {}  # label -> version that failed to load
+        self.scanned = {}  # label -> version seen on the previous scan
+        self.retiring = set()
+
+    def batcher(self, label):
+        """Returns the current Batcher for label, raising KeyError for unknown labels."""
+        return self.models[label].batchers[label]
+
+    def scan(self):
+        found = {}
+        for label in labels(self.model_root):
+            version = model_version(os.path.join(self.model_root, label))
+            if version is not None:
+                found[label] = version
+        return found
+
+    async def load(self):
+        """Loads and warms every label, for startup."""
+        await self.refresh(wait_for_stable=False)
+
+    async def refresh(self, wait_for_stable=True):
+        """Loads, tests and swaps in any new model versions."""
+        found = self.scan()
+        previous, self.scanned = self.scanned, found
+        for label in list(self.models):
+            if not os.path.lexists(self._dir(label)):
+                self.remove(label)
+        changed = {
+            label: version
+            for label, version in found.items()
+            if version != self.versions.get(label)
+            and version != self.rejected.get(label)
+            and (
+                not wait_for_stable
+                or os.path.islink(self._dir(label))
+                or version == previous.get(label)
+            )
+        }
+        if not changed:
+            return
+        if self.per_label:
+            groups = [{label: version} for label, version in changed.items()]
+        else:
+            groups = [found]
+
+        loop = asyncio.get_running_loop()
+        for group in groups:
+            log.info(f"loading models {group}")
+            dirs = {label: self._dir(label) for label in group}
+            models = None
+            try:
+                models = await loop.run_in_executor(None, self.build, dirs)
+                if models.start is not None:
+                    models.start()
+                await self.smoke_test(models)
+            except Exception as e:
+                log.error(f"models {group} failed to load, keeping the old ones: {e!r}")
+                self.rejected.update(group)
+                if models is not None:
+                    await self.retire(models)
+                continue
+            self.swap(group, models)
+
+    def _dir(self, label):
+        return os.path.join(self.model_root, label)
+
+    async def smoke_test(self, models):
+        for label, batcher in models.batchers.items():
+            results = await batcher.predict(SMOKE_TEXTS)
+            assert len(results) == len(SMOKE_TEXTS), f"{label}: wrong result count"
+            for result in results:
+                assert result["label"], f"{label}: no label in {result}"
+                assert 0.0 <= result["score"] <= 1.0, f"{label}: bad score {result}"
+
+    def swap(self, versions, models):
+        replaced = {self.models[label] for label in versions if label in self.models}
+        for label, version in versions.items():
+            self.models[label] = models
+            self.versions[label] = version
+            log.info(f"serving {label} version {version}")
+            if self.on_swap is not None:
+                self.on_swap(label)
+        for old in replaced:
+            self._retire_unused(old)
+
+    def remove(self, label):
+        """Stops serving label, whose model has been deleted."""
+        log.info(f"{label} was removed, no longer serving it")
+        models = self.models.pop(label)
+        del self.versions[label]
+        self.rejected.pop(label, None)
+        if self.on_swap is not None:
+            self.on_swap(label)
+        self._retire_unused(models)
+
+    def _retire_unused(self, models):
+        if models not in self.models.values():
+            task = asyncio.create_task(self.retire(models))
+            self.retiring.add(task)
+            task.add_done_callback(self.retiring.discard)
+
+    async def retire(self, models):
+        for batcher in models.batchers.values():
+            await batcher.drain()
+        if models.close is not None:
+            await asyncio.get_running_loop().run_in_executor(None, models.close)
+
+    async def watch(self):
+        """Checks for new model versions every interval seconds."""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.refresh()
+            except Exception as e:
+                log.error(f"failed to check for new models: {e!r}")
@@ -0,0 +1,136 @@
+# re-scores the archived tweets for a tag with its current model, offline.
+# usage: python -m classifier.rescore <tag> [--db tweets.db] [--models models] [--workers n]
+
+import argparse
+import collections
+import os
+import sys
+import time
+
+import streamer.tweetdb as tweetdb
+from classifier import workers
+from classifier.registry import model_version
+
+_SELECT_PAGE = "SELECT id, tweet FROM tweets WHERE tag=? AND id>? ORDER BY id LIMIT ?"
+_ADD_SCORE = "INSERT OR REPLACE INTO scores (tweet_id, tag, version, label, score) VALUES (?, ?, ?, ?, ?)"
+
+
+def resume_point(conn, tag, version):
+    """Returns the id up to which tag is already scored with version.  Pages are
+    committed whole and in id order, so everything at or below it is done."""
+    (last_id,) = conn.execute(
+        "SELECT max(tweet_id) FROM scores WHERE tag=? AND version=?", (tag, version)
+    ).fetchone()
+    return last_id or 0
+
+
+def pages(conn, tag, after, page_size):
+    """Yields the (id, text) rows for tag after the id after, page_size at a time."""
+    while True:
+        page = conn.execute(_SELECT_PAGE, (tag, after, page_size)).fetchall()
+        if not page:
+            return
+        yield page
+        after = page[-1][0]
+
+
+def submit_page(executor, tag, page, batch_size):
+    # batch texts of similar length together so little of each batch is padding
+    rows = sorted(page, key=lambda row: len(row[1]))
+    batches = [rows[i : i + batch_size] for i in range(0, len(rows), batch_size)]
+    futures = [
+        executor.submit(workers.predict, tag, [text for _, text in batch])
+        for batch in batches
+    ]
+    return batches, futures
+
+
+def write_page(conn, tag, version, batches, futures):
+    scores = []
+    for batch, future in zip(batches, futures):
+        for (id, _), result in zip(batch, future.result()):
+            scores.append((id, tag, version, result["label"], result["score"]))
+    with conn:
+        conn.executemany(_ADD_SCORE, scores)
+    return len(scores)
+
+
+def rescore(
+    tag,
+    db_path="tweets.db",
+    model_root="models",
+    num_workers=None,
+    batch_size=256,
+    page_size=8192,
+    pool=None,
+):
+    """Scores every tweet for tag with models/<tag> and writes the results to the scores
+    table under the model's version.  Rows are read in pages, each page is split into
+    batches run across a pool of worker processes, and pages are written back as they
+    finish, one transaction each.  An interrupted run picks up after the last page
+    written.  Returns the number of tweets scored."""
+    # the same version the classifier service reports for the model it serves
+    version = model_version(os.path.join(model_root, tag))
+    if version is None:
+        raise ValueError(f"no model for {tag} under {model_root}")
+    conn = tweetdb.connect(db_path)
+    after = resume_point(conn, tag, version)
+    (remaining,) = conn.execute(
+        "SELECT count(*) FROM tweets WHERE tag=? AND id>?", (tag, after)
+    ).fetchone()
+    print(f"scoring {remaining} {tag} tweets with model version {version}")
+    if after:
+        print(f"resuming after tweet {after}")
+
+    if pool is None:
+        pool = workers.WorkerPool(
+            model_root, num_workers or os.cpu_count(), labels=[tag]
+        )
+    pool.start()
+    scored = 0
+    start = time.perf_counter()
+    # one page is written while the next one runs, so the workers never sit idle
+    in_flight = collections.deque()
+    try:
+        for page in pages(conn, tag, after, page_size):
+            in_flight.append(submit_page(pool.executor, tag, page, batch_size))
+            if len(in_flight) > 1:
+                scored += write_page(conn, tag, version, *in_flight.popleft())
+                elapsed = time.perf_counter() - start
+                print(f"{scored}/{remaining} scored, {scored / elapsed:.0f} texts/s")
+        while in_flight:
+            scored += write_page(conn, tag, version, *in_flight.popleft())
+    finally:
+        for batches, futures in in_flight:
+            for future in futures:
+                future.cancel()
+        pool.shutdown()
+        conn.close()
+
+    elapsed = time.perf_counter() - start
+    print(
+        f"scored {scored} {tag} tweets in {elapsed:.1f}s, "
+        f"{scored / elapsed if elapsed else 0:.0f} texts/s"
+    )
+    return scored
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m classifier.rescore")
+    parser.add_argument("tag")
+    parser.add_argument("--db", default="tweets.db")
+    parser.add_argument("--models", default="models")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=256)
+    args = parser.parse_args(argv)
+    rescore(
+        args.tag,
+        db_path=args.db,
+        model_root=args.models,
+        num_workers=args.workers,
+        batch_size=args.batch_size,
+    )
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
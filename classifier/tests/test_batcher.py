@@ -0,0 +1,84 @@
+import asyncio
+import time
+
+import pytest
+from classifier.batcher import Batcher
+
+
+class FakeModel:
+    """Records the batches it's called with and labels each text with itself."""
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.batches = []
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        if self.fail:
+            raise RuntimeError("model failed")
+        return [{"label": text, "score": 0.5} for text in texts]
+
+
+@pytest.mark.asyncio
+async def test_results_in_order_per_caller():
+    model = FakeModel()
+    batcher = Batcher("ai", model, max_batch_size=32, max_wait_ms=10)
+    results = await asyncio.gather(
+        batcher.predict(["a", "b"]), batcher.predict(["c"]), batcher.predict(["d", "e"])
+    )
+    assert [[r["label"] for r in result] for result in results] == [
+        ["a", "b"],
+        ["c"],
+        ["d", "e"],
+    ]
+    # everything arrived within max_wait_ms, so it ran as one batch
+    assert model.batches == [["a", "b", "c", "d", "e"]]
+
+
+@pytest.mark.asyncio
+async def test_max_batch_size():
+    model = FakeModel()
+    batcher = Batcher("ai", model, max_batch_size=4, max_wait_ms=50, concurrency=2)
+    texts = [str(i) for i in range(10)]
+    results = await asyncio.gather(*(batcher.predict([text]) for text in texts))
+    assert [result[0]["label"] for result in results] == texts
+    assert [len(batch) for batch in model.batches] == [4, 4, 2]
+    assert sorted(sum(model.batches, [])) == sorted(texts)
+
+
+@pytest.mark.asyncio
+async def test_flush_after_max_wait():
+    model = FakeModel()
+    batcher = Batcher("ai", model, max_batch_size=32, max_wait_ms=20)
+    start = time.monotonic()
+    result = await batcher.predict(["alone"])
+    elapsed = time.monotonic() - start
+    assert result[0]["label"] == "alone"
+    assert model.batches == [["alone"]]
+    assert 0.015 <= elapsed < 0.5
+
+
+@pytest.mark.asyncio
+async def test_failure_raised_for_every_caller():
+    batcher = Batcher("ai", FakeModel(fail=True), max_wait_ms=10)
+    results = await asyncio.gather(
+        batcher.predict(["a"]), batcher.predict(["b"]), return_exceptions=True
+    )
+    assert all(isinstance(result, RuntimeError) for result in results)
+    # the batcher keeps serving after a failed batch
+    batcher.predict_fn = FakeModel()
+    assert (await batcher.predict(["c"]))[0]["label"] == "c"
+
+
+@pytest.mark.asyncio
+async def test_drain():
+    def slow_model(texts):
+        time.sleep(0.02)
+        return [{"label": text, "score": 0.5} for text in texts]
+
+    batcher = Batcher("ai", slow_model, max_wait_ms=1)
+    pending = asyncio.create_task(batcher.predict(["a"]))
+    await asyncio.sleep(0.005)
+    await batcher.drain()
+    assert pending.done()
+    assert batcher.outstanding == 0
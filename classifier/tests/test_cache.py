@@ -0,0 +1,61 @@
+from classifier.cache import CacheCollector, PredictionCache
+from prometheus_client import CollectorRegistry
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_normalized_hit():
+    cache = PredictionCache()
+    cache.put("ai", "Big  News https://t.co/abc", {"label": "positive"})
+    assert cache.get("ai", "big news https://t.co/xyz") == {"label": "positive"}
+    assert cache.get("whitepill", "big news") is None
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_ttl():
+    clock = FakeClock()
+    cache = PredictionCache(ttl=10, clock=clock)
+    cache.put("ai", "text", 1)
+    clock.now = 11
+    assert cache.get("ai", "text") is None
+
+
+def test_lru_eviction():
+    cache = PredictionCache(max_entries=2)
+    cache.put("ai", "a", 1)
+    cache.put("ai", "b", 2)
+    cache.get("ai", "a")
+    cache.put("ai", "c", 3)
+    assert cache.get("ai", "b") is None
+    assert cache.get("ai", "a") == 1
+    assert cache.stats()["evictions"] == 1
+
+
+def test_invalidate_label():
+    cache = PredictionCache()
+    cache.put("ai", "a", 1)
+    cache.put("eacc", "a", 2)
+    cache.invalidate("ai")
+    assert cache.get("ai", "a") is None
+    assert cache.get("eacc", "a") == 2
+
+
+def test_collector():
+    cache = PredictionCache(max_entries=1)
+    registry = CollectorRegistry()
+    registry.register(CacheCollector("test_cache", cache))
+    cache.put("ai", "a", 1)
+    cache.put("ai", "b", 2)
+    cache.get("ai", "b")
+    cache.get("ai", "a")
+    assert registry.get_sample_value("test_cache_hits_total") == 1
+    assert registry.get_sample_value("test_cache_misses_total") == 1
+    assert registry.get_sample_value("test_cache_evictions_total") == 1
+    assert registry.get_sample_value("test_cache_entries") == 1
@@ -0,0 +1,181 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.client_exceptions import ClientError, ContentTypeError
+from classifier.client import ClassifierClient
+from classifier.registry import VERSION_HEADER
+
+
+class FakeService:
+    """Stands in for ClassifierClient._request, answering with the current version."""
+
+    def __init__(self, version="ai@1", delay=0.0):
+        self.version = version
+        self.delay = delay
+        self.calls = []
+
+    async def __call__(self, method, url):
+        self.calls.append(url)
+        version = self.version
+        await asyncio.sleep(self.delay)
+        return [{"label": "positive", "score": 0.9, "version": version}], version
+
+
+@pytest.fixture
+def service(monkeypatch):
+    service = FakeService()
+    monkeypatch.setattr(ClassifierClient, "_request", service)
+    return service
+
+
+@pytest.mark.asyncio
+async def test_cache_keyed_by_model_version(service):
+    client = ClassifierClient()
+    assert (await client.predict("ai", "hello"))["version"] == "ai@1"
+    assert (await client.predict("ai", "hello"))["version"] == "ai@1"
+    assert len(service.calls) == 1
+
+    service.version = "ai@2"
+    await client.predict("ai", "another tweet")
+    # the swap was noticed, so the old model's results aren't reused
+    assert (await client.predict("ai", "hello"))["version"] == "ai@2"
+    assert len(service.calls) == 3
+    assert (await client.predict("ai", "hello"))["version"] == "ai@2"
+    assert len(service.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_late_response_from_old_model_not_cached(service):
+    client = ClassifierClient()
+    await client.predict("ai", "first")
+    service.delay = 0.02
+    late = asyncio.create_task(client.predict("ai", "slow"))
+    await asyncio.sleep(0.01)
+    service.version, service.delay = "ai@2", 0.0
+    await client.predict("ai", "second")
+    assert (await late)["version"] == "ai@1"
+
+    assert client.versions["ai"] == "ai@2"
+    assert (await client.predict("ai", "slow"))["version"] == "ai@2"
+
+
+class FlakyService:
+    """Fails the first failures attempts with error, then answers."""
+
+    def __init__(self, error, failures):
+        self.error = error
+        self.failures = failures
+        self.attempts = 0
+
+    async def __call__(self, method, url):
+        self.attempts += 1
+        if self.attempts <= self.failures:
+            raise self.error
+        return [{"label": "positive", "score": 0.9}], "ai@1"
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    sleeps = []
+    sleep = asyncio.sleep
+
+    async def record(delay, *args, **kwargs):
+        sleeps.append(delay)
+        await sleep(0)
+
+    monkeypatch.setattr(asyncio, "sleep", record)
+    return sleeps
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("error", [ClientError("reset"), asyncio.TimeoutError()])
+async def test_retries_with_backoff(monkeypatch, sleeps, error):
+    service = FlakyService(error, failures=2)
+    monkeypatch.setattr(ClassifierClient, "_request", service)
+    client = ClassifierClient(retries=2, backoff=0.25)
+    assert (await client.predict("ai", "hello"))["label"] == "positive"
+    assert service.attempts == 3
+    assert sleeps == [0.25, 0.5]
+
+
+@pytest.mark.asyncio
+async def test_gives_up_after_retries(monkeypatch, sleeps):
+    service = FlakyService(ClientError("reset"), failures=10)
+    monkeypatch.setattr(ClassifierClient, "_request", service)
+    client = ClassifierClient(retries=2)
+    assert await client.predict("ai", "hello") is None
+    assert service.attempts == 3
+
+
+@pytest.mark.asyncio
+async def test_no_retry_on_bad_response(monkeypatch, sleeps):
+    service = FlakyService(ContentTypeError(None, ()), failures=1)
+    monkeypatch.setattr(ClassifierClient, "_request", service)
+    client = ClassifierClient()
+    assert await client.predict("ai", "hello") is None
+    assert service.attempts == 1
+    assert sleeps == []
+
+
+@pytest.mark.asyncio
+async def test_identical_requests_share_a_call(service):
+    service.delay = 0.01
+    client = ClassifierClient(cache_size=0)
+    results = await asyncio.gather(
+        client.predict("ai", "hello"),
+        client.predict("ai", "hello"),
+        client.predict("whitepill", "hello"),
+    )
+    assert results[0] is results[1]
+    assert len(service.calls) == 2
+    assert not client.pending
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_doesnt_cancel_others(service):
+    service.delay = 0.02
+    client = ClassifierClient(cache_size=0)
+    first = asyncio.create_task(client.predict("ai", "hello"))
+    second = asyncio.create_task(client.predict("ai", "hello"))
+    await asyncio.sleep(0.005)
+    first.cancel()
+    assert (await second)["label"] == "positive"
+    assert first.cancelled()
+    assert len(service.calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_in_flight_cap():
+    # a real service, so the requests go through the client's connection pool
+    in_flight = peak = 0
+
+    async def handle(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.02)
+        in_flight -= 1
+        return web.json_response(
+            [{"label": "positive", "score": 0.9}],
+            headers={VERSION_HEADER: "ai@1"},
+        )
+
+    app = web.Application()
+    app.router.add_get("/predict/{label}", handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    client = ClassifierClient(f"http://127.0.0.1:{port}", max_in_flight=3)
+    try:
+        results = await asyncio.gather(
+            *(client.predict("ai", f"tweet {i}") for i in range(10))
+        )
+    finally:
+        await client.close()
+        await runner.cleanup()
+    assert all(result["label"] == "positive" for result in results)
+    assert peak == 3
+    assert client.versions == {"ai": "ai@1"}
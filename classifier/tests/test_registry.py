@@ -0,0 +1,197 @@
+import asyncio
+import os
+import time
+
+import pytest
+from classifier.batcher import Batcher
+from classifier.registry import ModelRegistry, Models, labels, model_version
+
+
+def write_model(model_root, name, weights):
+    model_dir = os.path.join(model_root, name)
+    os.makedirs(model_dir, exist_ok=True)
+    with open(os.path.join(model_dir, "config.json"), "w") as f:
+        f.write("{}")
+    with open(os.path.join(model_dir, "model.safetensors"), "w") as f:
+        f.write(weights)
+    return model_dir
+
+
+def publish(model_root, label, version, weights):
+    # what train.publish does: write a version directory, then swap the link
+    write_model(model_root, f"{label}@{version}", weights)
+    link = os.path.join(model_root, f"{label}@tmp")
+    os.symlink(f"{label}@{version}", link)
+    os.replace(link, os.path.join(model_root, label))
+
+
+class FakeBuilder:
+    """Builds batchers whose predictions name the weights they were loaded from."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.built = []
+        self.closed = []
+
+    def __call__(self, model_dirs):
+        batchers = {}
+        for label, model_dir in model_dirs.items():
+            with open(os.path.join(model_dir, "model.safetensors")) as f:
+                weights = f.read()
+            self.built.append(weights)
+
+            def predict_fn(texts, weights=weights):
+                if weights == "broken":
+                    return [{"label": "", "score": 2.0} for _ in texts]
+                time.sleep(self.delay)
+                return [{"label": weights, "score": 0.5} for _ in texts]
+
+            batchers[label] = Batcher(label, predict_fn)
+        return Models(batchers, close=lambda: self.closed.append(list(model_dirs)))
+
+
+def test_labels_and_versions(tmp_path):
+    root = str(tmp_path)
+    assert model_version(write_model(root, "ai", "v1")) is not None
+    os.makedirs(os.path.join(root, "incomplete"))
+    publish(root, "eacc", "20260101-000000", "v1")
+    assert labels(root) == ["ai", "eacc", "incomplete"]
+    assert model_version(os.path.join(root, "incomplete")) is None
+    assert model_version(os.path.join(root, "eacc")) == "eacc@20260101-000000"
+
+
+@pytest.mark.asyncio
+async def test_load_and_swap(tmp_path):
+    root = str(tmp_path)
+    publish(root, "ai", "1", "v1")
+    write_model(root, "eacc", "e1")
+    build = FakeBuilder()
+    swapped = []
+    registry = ModelRegistry(root, build, on_swap=swapped.append)
+    await registry.load()
+    assert sorted(swapped) == ["ai", "eacc"]
+    assert (await registry.batcher("ai").predict(["x"]))[0]["label"] == "v1"
+
+    # nothing changed, nothing is rebuilt
+    await registry.refresh()
+    assert sorted(build.built) == ["e1", "v1"]
+
+    publish(root, "ai", "2", "v2")
+    await registry.refresh()
+    assert (await registry.batcher("ai").predict(["x"]))[0]["label"] == "v2"
+    assert (await registry.batcher("eacc").predict(["x"]))[0]["label"] == "e1"
+    assert swapped[-1] == "ai"
+    await asyncio.gather(*registry.retiring)
+    assert len(build.closed) == 1
+    with pytest.raises(KeyError):
+        registry.batcher("unknown")
+
+
+@pytest.mark.asyncio
+async def test_old_model_drains_before_close(tmp_path):
+    root = str(tmp_path)
+    publish(root, "ai", "1", "v1")
+    build = FakeBuilder(delay=0.05)
+    registry = ModelRegistry(root, build)
+    await registry.load()
+
+    old = registry.batcher("ai")
+    in_flight = asyncio.create_task(old.predict(["x"]))
+    await asyncio.sleep(0.01)
+    publish(root, "ai", "2", "v2")
+    await registry.refresh()
+    assert registry.batcher("ai") is not old
+    assert build.closed == []
+    # the request that was already running finishes on the old model
+    assert (await in_flight)[0]["label"] == "v1"
+    await asyncio.gather(*registry.retiring)
+    assert build.closed == [["ai"]]
+
+
+@pytest.mark.asyncio
+async def test_failed_smoke_test_keeps_old_model(tmp_path):
+    root = str(tmp_path)
+    publish(root, "ai", "1", "v1")
+    build = FakeBuilder()
+    registry = ModelRegistry(root, build)
+    await registry.load()
+
+    publish(root, "ai", "2", "broken")
+    await registry.refresh()
+    assert registry.versions["ai"] == "ai@1"
+    assert (await registry.batcher("ai").predict(["x"]))[0]["label"] == "v1"
+    assert build.closed == [["ai"]]
+    # a rejected version isn't retried
+    await registry.refresh()
+    assert build.built == ["v1", "broken"]
+
+
+@pytest.mark.asyncio
+async def test_in_place_writes_wait_for_stable_version(tmp_path):
+    root = str(tmp_path)
+    write_model(root, "ai", "v1")
+    build = FakeBuilder()
+    registry = ModelRegistry(root, build)
+    await registry.load()
+    await registry.refresh()
+
+    write_model(root, "ai", "v2 but longer")
+    await registry.refresh()
+    assert (await registry.batcher("ai").predict(["x"]))[0]["label"] == "v1"
+    await registry.refresh()
+    assert (await registry.batcher("ai").predict(["x"]))[0]["label"] == "v2 but longer"
+
+
+@pytest.mark.asyncio
+async def test_models_started_on_loop_thread(tmp_path):
+    import threading
+
+    root = str(tmp_path)
+    publish(root, "ai", "1", "v1")
+    started = []
+
+    def build(model_dirs):
+        models = FakeBuilder()(model_dirs)
+        models.start = lambda: started.append(threading.current_thread())
+        return models
+
+    registry = ModelRegistry(root, build)
+    await registry.load()
+    assert started == [threading.main_thread()]
+
+
+@pytest.mark.asyncio
+async def test_removed_label_retired(tmp_path):
+    root = str(tmp_path)
+    publish(root, "ai", "1", "v1")
+    publish(root, "eacc", "1", "e1")
+    build = FakeBuilder()
+    swapped = []
+    registry = ModelRegistry(root, build, on_swap=swapped.append)
+    await registry.load()
+    # a link left mid publish is not a label
+    os.symlink("ai@1", os.path.join(root, "ai@tmp"))
+    assert registry.scan() == {"ai": "ai@1", "eacc": "eacc@1"}
+
+    os.remove(os.path.join(root, "eacc"))
+    await registry.refresh()
+    with pytest.raises(KeyError):
+        registry.batcher("eacc")
+    assert "eacc" not in registry.versions
+    assert swapped[-1] == "eacc"
+    await asyncio.gather(*registry.retiring)
+    assert build.closed == [["eacc"]]
+    assert (await registry.batcher("ai").predict(["x"]))[0]["label"] == "v1"
+
+
+@pytest.mark.asyncio
+async def test_missing_model_root(tmp_path):
+    root = str(tmp_path / "models")
+    registry = ModelRegistry(root, FakeBuilder())
+    await registry.load()
+    assert registry.models == {}
+
+    os.makedirs(root)
+    publish(root, "ai", "1", "v1")
+    await registry.refresh()
+    assert (await registry.batcher("ai").predict(["x"]))[0]["label"] == "v1"
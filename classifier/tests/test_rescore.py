@@ -0,0 +1,97 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from classifier import rescore, workers
+from streamer.tweetdb import TweetDB, connect
+
+
+class FakePool:
+    """Runs workers.predict on threads instead of forked processes."""
+
+    def __init__(self):
+        self.executor = None
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(2)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class FakeClassifier:
+    def __init__(self, fail_on=None):
+        self.fail_on = fail_on
+        self.texts = []
+
+    def __call__(self, texts, batch_size=None, truncation=True):
+        if self.fail_on in texts:
+            raise RuntimeError("interrupted")
+        self.texts.extend(texts)
+        return [
+            {"label": "positive" if "good" in text else "negative", "score": 0.9}
+            for text in texts
+        ]
+
+
+@pytest.fixture
+def archive(tmp_path):
+    db_path = str(tmp_path / "tweets.db")
+    db = TweetDB(db_path)
+    for i in range(50):
+        db.add(f"{'good' if i % 2 else 'bad'} tweet {i}", f"url{i}", "ai")
+    db.add("other tag", "url-other", "eacc")
+    model_dir = tmp_path / "models" / "ai"
+    model_dir.mkdir(parents=True)
+    (model_dir / "config.json").write_text("{}")
+    (model_dir / "model.safetensors").write_bytes(b"weights v1")
+    return db_path, str(tmp_path / "models")
+
+
+def scores(db_path):
+    return (
+        connect(db_path)
+        .execute("SELECT tweet_id, tag, version, label FROM scores ORDER BY tweet_id")
+        .fetchall()
+    )
+
+
+def test_rescore(archive, monkeypatch):
+    db_path, model_root = archive
+    monkeypatch.setitem(workers._classifiers, "ai", FakeClassifier())
+    scored = rescore.rescore(
+        "ai", db_path, model_root, batch_size=4, page_size=10, pool=FakePool()
+    )
+    assert scored == 50
+    rows = scores(db_path)
+    assert [row[0] for row in rows] == list(range(1, 51))
+    assert {row[1] for row in rows} == {"ai"}
+    assert rows[1][3] == "positive" and rows[0][3] == "negative"
+
+
+def test_rescore_resumes(archive, monkeypatch):
+    db_path, model_root = archive
+    monkeypatch.setitem(
+        workers._classifiers, "ai", FakeClassifier(fail_on="bad tweet 34")
+    )
+    with pytest.raises(RuntimeError):
+        rescore.rescore("ai", db_path, model_root, page_size=10, pool=FakePool())
+    # pages are written whole, so the failure left 3 of them
+    assert len(scores(db_path)) == 30
+
+    classifier = FakeClassifier()
+    monkeypatch.setitem(workers._classifiers, "ai", classifier)
+    assert (
+        rescore.rescore("ai", db_path, model_root, page_size=10, pool=FakePool()) == 20
+    )
+    assert len(classifier.texts) == 20
+    assert len(scores(db_path)) == 50
+
+
+def test_new_model_version(archive, monkeypatch):
+    db_path, model_root = archive
+    monkeypatch.setitem(workers._classifiers, "ai", FakeClassifier())
+    rescore.rescore("ai", db_path, model_root, pool=FakePool())
+    with open(f"{model_root}/ai/model.safetensors", "wb") as f:
+        f.write(b"weights v2")
+    assert rescore.rescore("ai", db_path, model_root, pool=FakePool()) == 50
+    assert len({row[2] for row in scores(db_path)}) == 2
@@ -1,91 +1,208 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import time
 import numpy as np
-import pandas as pd
-from datasets import load_dataset
+import torch
+from datasets import Dataset, DatasetDict, load_from_disk
 import streamer.tweetdb as tweetdb
+from classifier import onnxbackend
 from transformers import AutoTokenizer
-from transformers import DataCollatorWithPadding
+from transformers import DataCollatorWithPadding, EarlyStoppingCallback
 from transformers import AutoModelForSequenceClassification, TrainingArguments, Trainer
 import evaluate
 import sys
 
 
-# The following lines adjust the granularity of reporting.
-pd.options.display.max_rows = 10
-pd.options.display.float_format = "{:.1f}".format
+BASE_MODEL = "distilbert-base-uncased"
+# tokens are cached here per row, see tokenize_split
+TOKENIZED_CACHE = "tokenized_cache"
+# written next to the model, records which annotations it was trained on
+STATE_FILENAME = "training_state.json"
+# tweets are at most 280 characters, which stays well under this many tokens
+MAX_LENGTH = 128
+TOKENIZE_PROCS = min(8, os.cpu_count() or 1)
+
+# tweets in the TweetDB that have reactions are annotated.  For now we only have two annotations:
+# ❌ and ✅
+annotations = {
+    "positive": "✅",
+    "negative": "❌",
+}
+reaction_to_annotation = {v: k for k, v in annotations.items()}
+id2label = {0: "negative", 1: "positive"}
+label2id = {"negative": 0, "positive": 1}
+
+
+def annotated_examples(tag, state=None):
+    """Streams the annotated tweets for tag straight out of the database.  state is
+    only there so the datasets cache sees a new fingerprint when annotations change."""
+    db = tweetdb.TweetDB()
+    for id, url, text, _, reaction in db.iter_annotated(tag, annotations.values()):
+        yield {
+            "id": id,
+            "text": text,
+            "label": label2id[reaction_to_annotation[reaction]],
+        }
 
 
 def get_dataset(tag):
-    # tweets in the TweetDB that have reactions are annotated.  For now we only have two annotations:
-    # ❌ and ✅
-    annotations = {
-        "positive": "✅",
-        "negative": "❌",
-    }
-    reaction_to_annotation = {v: k for k, v in annotations.items()}
-
-    # get the annotated tweets from the database
     db = tweetdb.TweetDB()
-    tweets = db.get_annotated(tag, annotations.values())
-
-    # update the reaction field to be the annotation
-    for tweet in tweets:
-        tweet[3] = reaction_to_annotation[tweet[3]]
-
-    # write out the changes
-    with open("annotated_tweets.csv", "w") as f:
-        for tweet in tweets:
-            text = tweet[1]
-            annotation = reaction_to_annotation[tweet[3]]
-            # remove all \n and \t from the string
-            text = text.replace("\t", " ")
-            text = text.replace("\n", " ")
-            f.write(f"{text}\t{annotation}\n")
-
-    # load annotated_tweets.csv and split it into a test and train set
-    df = pd.read_csv("annotated_tweets.csv", sep="\t")
-    df.columns = ["text", "label"]
-    # randomize the entries in
-    np.random.seed(42)
-    df = df.reindex(np.random.permutation(df.index))
-
-    # convert the labels to 0 and 1
-    df.loc[df["label"] == "positive", "label"] = 1
-    df.loc[df["label"] == "negative", "label"] = 0
-    df[: int(len(df) * 0.8)].to_csv("df_train.csv", index=False, sep="\t")
-    df[int(len(df) * 0.8) :].to_csv("df_test.csv", index=False, sep="\t")
-
-    id2label = {0: "negative", 1: "positive"}
-    label2id = {"negative": 0, "positive": 1}
-
-    dataset = load_dataset(
-        "csv",
-        data_files={"train": "df_train.csv", "test": "df_test.csv"},
-        delimiter="\t",
+    state = db.annotation_state(tag, annotations.values())
+    dataset = Dataset.from_generator(
+        annotated_examples, gen_kwargs={"tag": tag, "state": state}
+    )
+    # split on the row id so a tweet stays on the same side of the split as more
+    # annotations come in, which incremental runs rely on
+    dataset = DatasetDict(
+        {
+            "train": dataset.filter(lambda row: row["id"] % 5 != 0),
+            "test": dataset.filter(lambda row: row["id"] % 5 == 0),
+        }
     )
-
     return dataset, id2label, label2id
 
 
-def tokenize_dataset(dataset):
-    data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
+def row_key(id, text):
+    """Keys a row's tokens in the cache by its id and a hash of its text, so editing a
+    tweet or reusing an id re-tokenizes it but re-annotating it doesn't."""
+    return f"{id}:{hashlib.sha256(text.encode()).hexdigest()[:16]}"
+
+
+def load_token_cache(path, columns):
+    """Returns {row key: {column: tokens}} from the cache at path."""
+    if not os.path.exists(path):
+        return {}
+    cached = load_from_disk(path)
+    rows = zip(*(cached[column] for column in columns))
+    return {key: dict(zip(columns, row)) for key, row in zip(cached["key"], rows)}
+
+
+def save_token_cache(path, columns, cache):
+    # write next to the old cache and swap it in, the old one may still be mapped
+    keys = list(cache)
+    data = {"key": keys}
+    for column in columns:
+        data[column] = [cache[key][column] for key in keys]
+    Dataset.from_dict(data).save_to_disk(path + ".tmp")
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(path + ".tmp", path)
+
+
+def tokenize_split(dataset, tokenizer):
+    """Tokenizes a split.  Tokens are cached per row, keyed by row_key, so only rows
+    that weren't tokenized before are run through the tokenizer and the rest are
+    read back from the cache."""
 
     def preprocess_function(examples):
-        return tokenizer(examples["text"], truncation=True, padding=True)
+        # no padding here, the collator pads each batch to its own longest example
+        return tokenizer(examples["text"], truncation=True, max_length=MAX_LENGTH)
+
+    # one cache per tokenizer and length limit, shared by both splits
+    settings = json.dumps([tokenizer.name_or_path, MAX_LENGTH]).encode()
+    path = os.path.join(TOKENIZED_CACHE, hashlib.sha256(settings).hexdigest()[:24])
+    columns = tokenizer.model_input_names
+    cache = load_token_cache(path, columns)
+
+    keys = [row_key(id, text) for id, text in zip(dataset["id"], dataset["text"])]
+    missing = [i for i, key in enumerate(keys) if key not in cache]
+    print(f"tokenizing {len(missing)} rows, {len(keys) - len(missing)} cached")
+    if missing:
+        tokenized = dataset.select(missing).map(
+            preprocess_function,
+            batched=True,
+            num_proc=TOKENIZE_PROCS if len(missing) >= 1000 else None,
+            remove_columns=dataset.column_names,
+        )
+        for i, row in zip(missing, tokenized):
+            cache[keys[i]] = {column: row[column] for column in columns}
+        save_token_cache(path, columns, cache)
+
+    for column in columns:
+        dataset = dataset.add_column(column, [cache[key][column] for key in keys])
+    return dataset
+
+
+class PaddingStatsCollator(DataCollatorWithPadding):
+    """Pads batches like DataCollatorWithPadding and counts real and padded tokens."""
+
+    real_tokens = 0
+    total_tokens = 0
+
+    def __call__(self, features):
+        batch = super().__call__(features)
+        mask = batch["attention_mask"]
+        self.real_tokens += int(mask.sum())
+        self.total_tokens += mask.numel()
+        return batch
+
+    def report(self, seconds):
+        waste = 1 - self.real_tokens / self.total_tokens if self.total_tokens else 0.0
+        print(
+            f"{self.real_tokens / seconds:.0f} tokens/s, "
+            f"padding waste {waste:.1%} of {self.total_tokens} batch tokens"
+        )
 
-    tokenizer = AutoTokenizer.from_pretrained("distilbert-base-uncased")
-    tokenized_data = dataset.map(preprocess_function, batched=True)
+
+def tokenize_dataset(dataset):
+    tokenizer = AutoTokenizer.from_pretrained(BASE_MODEL)
+    data_collator = PaddingStatsCollator(tokenizer=tokenizer)
+    tokenized_data = DatasetDict(
+        {split: tokenize_split(data, tokenizer) for split, data in dataset.items()}
+    )
     return tokenizer, tokenized_data, data_collator
 
 
-def load_model(id2label, label2id):
+def load_model(id2label, label2id, model_path=BASE_MODEL):
     model = AutoModelForSequenceClassification.from_pretrained(
-        f"distilbert-base-uncased", num_labels=2, id2label=id2label, label2id=label2id
+        model_path, num_labels=2, id2label=id2label, label2id=label2id
     )
     return model
 
 
-def train(model, dataset, tag):
+def load_state(model_dir):
+    """Returns {row id: label} for the annotations the model in model_dir was trained
+    on."""
+    try:
+        with open(os.path.join(model_dir, STATE_FILENAME)) as f:
+            return {int(id): label for id, label in json.load(f)["trained"].items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(model_dir, train_split):
+    trained = dict(zip(train_split["id"], train_split["label"]))
+    with open(os.path.join(model_dir, STATE_FILENAME), "w") as f:
+        json.dump({"trained": trained}, f)
+
+
+def incremental_rows(train_split, state, replay_ratio=1.0, min_replay=200):
+    """Returns the indices of the rows that are new or re-annotated since the last
+    run, plus a random replay sample of the rest so the model doesn't forget them.
+    None if nothing changed."""
+    ids, labels = train_split["id"], train_split["label"]
+    new = [
+        i for i, (id, label) in enumerate(zip(ids, labels)) if state.get(id) != label
+    ]
+    if not new:
+        return None
+    new_rows = set(new)
+    old = [i for i in range(len(ids)) if i not in new_rows]
+    replay = max(min_replay, int(len(new) * replay_ratio))
+    replay = random.Random(42).sample(old, min(replay, len(old)))
+    print(f"training on {len(new)} new annotations and {len(replay)} replayed ones")
+    return sorted(new + replay)
+
+
+def train(model, dataset, tag, epochs=20, patience=3, train_rows=None):
+    # the full splits are tokenized and then subset; only rows that are new since
+    # the last run go through the tokenizer, the rest come from the cache
     tokenizer, tokenized_data, data_collator = tokenize_dataset(dataset)
+    if train_rows is not None:
+        tokenized_data["train"] = tokenized_data["train"].select(train_rows)
     accuracy = evaluate.load("accuracy")
 
     @torch.no_grad()
@@ -99,11 +216,17 @@ def train(model, dataset, tag):
         learning_rate=2e-5,
         per_device_train_batch_size=16,
         per_device_eval_batch_size=16,
-        num_train_epochs=20,
+        num_train_epochs=epochs,
         weight_decay=0.01,
         evaluation_strategy="epoch",
         save_strategy="epoch",
+        # with load_best_model_at_end this keeps just the best checkpoint (and the
+        # latest, while it's still being compared)
+        save_total_limit=1,
         load_best_model_at_end=True,
+        metric_for_best_model="accuracy",
+        # batch examples of similar length together so there's little to pad
+        group_by_length=True,
         push_to_hub=False,
     )
 
@@ -115,15 +238,76 @@ def train(model, dataset, tag):
         data_collator=data_collator,
         tokenizer=tokenizer,
         compute_metrics=compute_metrics,
+        callbacks=[EarlyStoppingCallback(early_stopping_patience=patience)],
     )
-    trainer.train()
+    result = trainer.train()
+    # counts cover the evaluation batches too, which run inside train()
+    data_collator.report(result.metrics["train_runtime"])
+    return tokenizer
 
 
-def main(tag):
+def export_onnx(model, tokenizer, model_dir, dataset):
+    """Writes a quantized ONNX copy of the model for the CPU backend, and removes it again
+    if it doesn't match the PyTorch model on the test split."""
+    if onnxbackend.ort is None:
+        print("onnxruntime is not installed, skipping ONNX export")
+        return
+
+    onnxbackend.export(model, tokenizer, model_dir)
+    try:
+        onnxbackend.parity_check(model_dir, dataset["test"]["text"])
+    except AssertionError as e:
+        print(f"ONNX parity check failed, serving with PyTorch: {e}")
+        os.remove(onnxbackend.onnx_path(model_dir))
+
+
+def publish(model_dir, version_dir, keep=3):
+    """Points model_dir at version_dir by swapping a symlink, which is atomic, so a
+    server watching model_dir never loads a half written model.  A model_dir from
+    before versioning is moved aside to <model_dir>@legacy first.  Only the newest keep
+    versions are kept."""
+    if os.path.isdir(model_dir) and not os.path.islink(model_dir):
+        os.rename(model_dir, f"{model_dir}@legacy")
+    # named like a version, so a server scanning the models never takes it for a label
+    link = f"{model_dir}@tmp"
+    if os.path.lexists(link):
+        os.remove(link)
+    os.symlink(os.path.basename(version_dir), link)
+    os.replace(link, model_dir)
+    print(f"{model_dir} is now {version_dir}")
+
+    versions = sorted(
+        name
+        for name in os.listdir(os.path.dirname(model_dir))
+        if name.startswith(os.path.basename(model_dir) + "@")
+        and not name.endswith(("@legacy", "@tmp"))
+    )
+    for name in versions[:-keep]:
+        shutil.rmtree(os.path.join(os.path.dirname(model_dir), name))
+
+
+def main(tag, incremental=False):
     dataset, id2label, label2id = get_dataset(tag)
-    model = load_model(id2label, label2id)
-    train(model, dataset, tag)
-    model.save_pretrained(f"models/{tag}")
+    model_dir = f"models/{tag}"
+    # every run writes a new version, which is only published once it's complete
+    version_dir = f"{model_dir}@{time.strftime('%Y%m%d-%H%M%S')}"
+
+    if incremental and os.path.exists(model_dir):
+        rows = incremental_rows(dataset["train"], load_state(model_dir))
+        if rows is None:
+            print(f"no new annotations for {tag}, nothing to do")
+            return
+        model = load_model(id2label, label2id, model_dir)
+        tokenizer = train(model, dataset, tag, epochs=5, patience=2, train_rows=rows)
+    else:
+        model = load_model(id2label, label2id)
+        tokenizer = train(model, dataset, tag)
+
+    model.save_pretrained(version_dir)
+    tokenizer.save_pretrained(version_dir)
+    save_state(version_dir, dataset["train"])
+    export_onnx(model, tokenizer, version_dir, dataset)
+    publish(model_dir, version_dir)
 
 
 if __name__ == "__main__":
@@ -131,7 +315,7 @@ if __name__ == "__main__":
     try:
         tag = sys.argv[1]
     except:
-        print(f"Usage: python train.py <tag>")
+        print("Usage: python train.py <tag> [--incremental]")
         sys.exit(1)
 
-    sys.exit(main(tag))
+    sys.exit(main(tag, incremental="--incremental" in sys.argv[2:]))
@@ -0,0 +1,131 @@
+# pool of inference worker processes sharing model weights with the server process.
+
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import glog as log
+
+# label -> classifier.  Filled in by the server process before the workers are forked,
+# so each worker sees the parent's models without loading or copying them.
+_classifiers = {}
+
+
+def memory_usage():
+    """Returns this process's memory use in MiB.  pss splits shared pages between the
+    processes mapping them, so it is what shows whether the weights are really shared."""
+    usage = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                fields = line.split()
+                if fields[0] in ("Rss:", "Pss:", "Shared_Clean:", "Shared_Dirty:"):
+                    usage[fields[0][:-1].lower()] = int(fields[1]) / 1024
+    except OSError:
+        # no smaps on this platform, peak rss is the best we can do
+        usage["rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return usage
+
+
+def _init_worker(threads, local_models):
+    import torch
+
+    torch.set_num_threads(threads)
+    # label -> model dir for the models each worker has to load itself
+    for label, model_dir in local_models.items():
+        from classifier import onnxbackend
+
+        _classifiers[label] = onnxbackend.OnnxClassifier(model_dir, threads)
+    log.info(f"inference worker {os.getpid()} started: {memory_usage()}")
+
+
+def _report(delay):
+    # hold the worker for a moment so every worker gets one report request
+    time.sleep(delay)
+    return os.getpid(), memory_usage()
+
+
+def predict(label, texts):
+    return _classifiers[label](texts, batch_size=len(texts), truncation=True)
+
+
+class WorkerPool:
+    """WorkerPool serves predictions from num_workers forked processes.  PyTorch models
+    are loaded once in the server process and their tensors moved to shared memory
+    before forking, so every worker maps the same weights.  ONNX Runtime sessions can't
+    be shared across a fork, so labels with an ONNX artifact are opened by each worker;
+    the quantized graphs are a fraction of the size of the PyTorch weights.  Every
+    model under model_root is loaded unless labels names the ones to load.
+
+    start loads the models and forks the workers.  A server that loads models off its
+    event loop calls load there and fork from the loop's thread instead, so the workers
+    aren't forked from a helper thread while other threads may hold locks."""
+
+    def __init__(self, model_root, num_workers, use_onnx=True, labels=None):
+        self.model_root = model_root
+        self.num_workers = num_workers
+        self.use_onnx = use_onnx
+        self.only = labels
+        self.local_models = {}
+        self.executor = None
+
+    def labels(self):
+        if self.only is not None:
+            return sorted(self.only)
+        from classifier.registry import labels
+
+        return labels(self.model_root)
+
+    def start(self):
+        self.load()
+        self.fork()
+        self.report()
+
+    def load(self):
+        """Loads the models the workers will share."""
+        from classifier import onnxbackend
+        from transformers import pipeline
+
+        # the workers only see this pool's models, not those of an earlier pool
+        _classifiers.clear()
+        self.local_models = {}
+        for label in self.labels():
+            model_dir = os.path.join(self.model_root, label)
+            if self.use_onnx and onnxbackend.available(model_dir):
+                self.local_models[label] = model_dir
+                continue
+            # transformers memory-maps safetensors checkpoints, share_memory then
+            # keeps the tensors in shared pages the forked workers can map as-is
+            classifier = pipeline("sentiment-analysis", model=model_dir)
+            classifier.model.share_memory()
+            _classifiers[label] = classifier
+        log.info(f"server process {os.getpid()} loaded models: {memory_usage()}")
+
+        threads = max(1, os.cpu_count() // self.num_workers)
+        self.executor = ProcessPoolExecutor(
+            self.num_workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+            initargs=(threads, self.local_models),
+        )
+
+    def fork(self):
+        """Forks the workers from the calling thread.  The executor forks every worker
+        on its first submit, so this submits a no-op."""
+        self.executor.submit(os.getpid)
+
+    def report(self):
+        """Logs the memory use of each worker."""
+        futures = [self.executor.submit(_report, 0.2) for _ in range(self.num_workers)]
+        reports = dict(future.result() for future in futures)
+        for pid, usage in sorted(reports.items()):
+            log.info(f"inference worker {pid}: {usage}")
+        return reports
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.local_models = {}
+        self.executor = None
@@ -1,19 +1,23 @@
 import asyncio
-import datetime
 import json
+import os
 import re
 import glog as log
 import unicodedata
 
 import discord
 import asyncopenai.asyncopenai as openai
+from prometheus_client import REGISTRY
 
+from streamer import metrics
 from streamer.twitterfeed import TwitterFeed
 from streamer.eventfilter import EventFilter
 from streamer.dispatcher import Dispatcher
-from streamer.tweetdb import TweetDB
+from streamer.watchdog import Supervisor
+from streamer.tweetdb import MessageIndex, TweetWriter
 from streamer.repeatdb import RepeatDB
-from classifier import client as classifier_client
+from classifier.cache import CacheCollector
+from classifier.client import ClassifierClient
 
 
 def get_bot_token():
@@ -24,15 +28,25 @@ def get_bot_token():
 
 client = discord.Client(intents=discord.Intents.default())
 
+# shared by every filter so they all use the same connection pool
+classifier_client = ClassifierClient()
+
+# long-lived handles on tweets.db shared by the feed, dispatcher and reactions
+tweet_writer = TweetWriter()
+message_index = MessageIndex(tweet_writer)
+
 # on_ready initializes the bot and starts the streamer
 @client.event
 async def on_ready():
     log.info(f"We have logged in as {client.user}")
     log.info("initializing feed")
-    feed = TwitterFeed()
+    # STREAMER_RECORD=path records the raw stream for python -m streamer.replay
+    feed = TwitterFeed(
+        tweetdb=tweet_writer, record_path=os.environ.get("STREAMER_RECORD")
+    )
 
     log.info(f"initializing dispatcher")
-    dispatcher = Dispatcher(client, feed)
+    dispatcher = Dispatcher(client, feed, messages=message_index)
 
     log.info(f"adding content filters")
     await add_filters(dispatcher)
@@ -40,14 +54,31 @@ async def on_ready():
     log.info("Monitoring stream.")
     asyncio.get_event_loop().create_task(dispatcher.monitor_feed())
 
+    # twitter sends a keep-alive every 20 seconds, so a quiet stream is a dead one.
+    # dispatch and send only stall if they have work waiting.
+    supervisor = Supervisor()
+    supervisor.watch("stream", 120, recover=feed.reconnect)
+    supervisor.watch(
+        "dispatch", 300, busy=lambda: dispatcher.qsize() or dispatcher.in_flight
+    )
+    supervisor.watch(
+        "send", 300, busy=lambda: any(s.qsize() for s in dispatcher.senders.values())
+    )
+    asyncio.get_event_loop().create_task(supervisor.run())
 
-# the way we are sending messages, they are not being added to the
-# cache, so we need to retrieve messages in order to parse them when
-# a reaction occurs.
-@client.event
-async def on_raw_reaction_add(payload):
+
+async def fetch_tweet_urls(payload):
+    """Recovers the tweet urls from the message itself, for messages sent before the
+    message index existed.  Messages can carry several tweets."""
     channel = client.get_channel(payload.channel_id)
     message = await channel.fetch_message(payload.message_id)
+    if message.author != client.user:
+        return []
+    return re.findall(r"https://twitter.com/i/web/status/\d+", message.content)
+
+
+@client.event
+async def on_raw_reaction_add(payload):
     emoji = payload.emoji
 
     try:
@@ -56,22 +87,25 @@ async def on_raw_reaction_add(payload):
         log.info(f"skipping reaction {emoji.name}: non-unicode response.")
         return
 
-    # parse the message content
-    if message.author != client.user:
-        log.info(f"skipping reaction {character}: not author")
-        return
+    urls = message_index.lookup(payload.message_id)
+    if not urls:
+        urls = await fetch_tweet_urls(payload)
+        if not urls:
+            log.info(f"skipping reaction {character}: not a tweet message")
+            return
 
-    match = re.search(r"https://twitter.com/i/web/status/(\d+)", message.content)
-    if match:
-        url = match.group(0)
-    else:
-        log.info(f"skipping reaction {character}: improperly formatted message")
+    if len(urls) > 1:
+        # one reaction can't say which of the tweets it's about, and labelling them
+        # all alike would put wrong labels in the training data
+        log.info(
+            f"skipping reaction {character}: message {payload.message_id} holds "
+            f"{len(urls)} tweets"
+        )
         return
 
-    log.info(f"Saving reaction {character} to {url}")
-    tdb = TweetDB()
+    log.info(f"Saving reaction {character} to {urls[0]}")
     # save the reaction text to the database
-    tdb.set_reaction(url, emoji.name)
+    tweet_writer.set_reaction(urls[0], emoji.name)
 
 
 @client.event
@@ -79,24 +113,6 @@ async def on_message(message):
     log.info(
         f"#{message.channel.name}:{message.channel.id} <{message.author}> {message.content}"
     )
-    if message.author == client.user:
-        activity = datetime.datetime.now()
-        return
-
-
-# for stall detection
-activity = datetime.datetime.now()
-
-# We get stalls on the twitter feed, this is a workaround for now.
-# TODO: we seem to stall out sometimes for other reasons as well, this needs more investigation.
-async def activity_check(max_idle=600):
-    global activity
-    while True:
-        await asyncio.sleep(10)
-        max_age = datetime.datetime.now() - datetime.delta(seconds=max_idle)
-        if activity < max_age:
-            log.warn(f"No activity for {max_idle} seconds, exiting")
-            return
 
 
 async def create_filter(
@@ -160,10 +176,13 @@ async def add_filters(dispatcher):
 
 def main():
     # this starts everything.
-    c = client.run(get_bot_token())
-    loop = asyncio.get_event_loop()
-    loop.run_until_complete(activity_check())
-    loop.close()
+    if classifier_client.cache is not None:
+        REGISTRY.register(
+            CacheCollector("streamer_classifier_cache", classifier_client.cache)
+        )
+    metrics.start(int(os.environ.get("STREAMER_METRICS_PORT", 9100)))
+    tweet_writer.start()
+    client.run(get_bot_token())
 
 
 if __name__ == "__main__":
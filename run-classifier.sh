@@ -1 +1,8 @@
-uvicorn classifier.main:app --reload
+# CLASSIFIER_MAX_BATCH_SIZE and CLASSIFIER_MAX_WAIT_MS tune request batching.
+# ./run-classifier.sh prod serves with a pool of inference workers, one per core
+# unless CLASSIFIER_WORKERS says otherwise.
+if [ "$1" = "prod" ]; then
+    CLASSIFIER_WORKERS=${CLASSIFIER_WORKERS:-$(nproc)} uvicorn classifier.main:app
+else
+    uvicorn classifier.main:app --reload
+fi
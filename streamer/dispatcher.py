@@ -1,36 +1,163 @@
 # dispatches tweets from the feed to channels.
 
 import asyncio
+import collections
+import time
+
+import glog as log
 import tweepy
 
-from . import eventfilter
+from . import eventfilter, metrics, watchdog
+from .sender import CHANNEL_RATE, ChannelSender, TokenBucket
+from .workcontext import WorkContexts
 
 
 class Dispatcher:
-    def __init__(self, discord_client, feed):
-        """Iniitializes the monitor"""
+    def __init__(
+        self,
+        discord_client,
+        feed,
+        messages=None,
+        num_workers=32,
+        tag_concurrency=8,
+        queue_size=1000,
+        channel_rate=CHANNEL_RATE,
+    ):
+        """Iniitializes the monitor.  If messages is a MessageIndex, every message sent
+        is recorded in it.  Each tag gets its own queue of up to queue_size events and
+        tag_concurrency workers, so a slow tag only backs up its own queue; at most
+        num_workers events across all tags are dispatched at once.  Each channel gets
+        its own send queue, limited to channel_rate (messages, seconds)."""
         self.discord_client = discord_client
         self.feed = feed
+        self.messages = messages
         self.filters = {}
         self.rules = []
 
+        self.num_workers = num_workers
+        self.tag_concurrency = tag_concurrency
+        self.queue_size = queue_size
+        self.slots = asyncio.Semaphore(num_workers)
+        # a full tag queue stops us reading from the feed, and the backlog builds up
+        # in the feed's bounded queue instead
+        self.queues = {}
+        self.in_flight = 0  # events taken off a tag queue and not dispatched yet
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=1000))
+        self.channel_rate = channel_rate
+        self.senders = {}
+        # a tweet matching several rules is queued once per tag, these let its
+        # filters share the work that doesn't depend on the tag
+        self.contexts = WorkContexts()
+
     def add_filter(self, filter):
         """Adds a content filter to the monitor"""
         self.filters[filter.tag] = filter
+        self.queues[filter.tag] = asyncio.Queue(self.queue_size)
         self.rules.append(tweepy.StreamRule(value=filter.get_filter(), tag=filter.tag))
 
+    def stats(self):
+        """Returns the number of events in flight, queue depths, per-tag dispatch
+        latency percentiles over the last 1000 events and, per channel, the send queue
+        depth and how long tweets waited to be sent."""
+        stats = {
+            "in_flight": self.in_flight,
+            "queue_depth": self.qsize(),
+            "latency": {},
+        }
+        if hasattr(self.feed, "get_qsize"):
+            stats["feed_queue_depth"] = self.feed.get_qsize()
+        for tag, latencies in self.latencies.items():
+            stats["latency"][tag] = percentiles(latencies)
+        stats["channels"] = {
+            channel_id: {
+                "queue_depth": sender.qsize(),
+                "send_latency": percentiles(sender.latencies),
+            }
+            for channel_id, sender in self.senders.items()
+        }
+        return stats
+
+    def qsize(self):
+        """Returns the number of events waiting in the tag queues."""
+        return sum(queue.qsize() for queue in self.queues.values())
+
+    def sender(self, channel_id):
+        """Returns the send queue for a channel."""
+        if channel_id not in self.senders:
+            self.senders[channel_id] = ChannelSender(
+                self.discord_client.get_channel(channel_id),
+                TokenBucket(*self.channel_rate),
+                messages=self.messages,
+            )
+        return self.senders[channel_id]
+
     async def monitor_feed(self):
         """Monitors the twitter feed and dispatches tweets to the proper channel""" ""
         await self.feed.set_rules(self.rules)
 
-        async for event, tag in self.feed:
-            asyncio.create_task(self.dispatch(event, tag))
+        metrics.QUEUE_DEPTH.labels("dispatch").set_function(self.qsize)
+        if hasattr(self.feed, "get_qsize"):
+            metrics.QUEUE_DEPTH.labels("feed").set_function(self.feed.get_qsize)
+        metrics.IN_FLIGHT.set_function(lambda: self.in_flight)
+
+        workers = [
+            asyncio.create_task(self._worker(tag))
+            for tag in self.queues
+            for _ in range(self.tag_concurrency)
+        ]
+        try:
+            async for event, tag in self.feed:
+                if tag not in self.queues:
+                    log.error(f"[{tag}] no filter for {event.get('url')}")
+                    continue
+                await self.queues[tag].put(event)
+            for queue in self.queues.values():
+                await queue.join()
+            for sender in self.senders.values():
+                await sender.drain()
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    async def _worker(self, tag):
+        queue = self.queues[tag]
+        while True:
+            event = await queue.get()
+            self.in_flight += 1
+            if "received" in event:
+                metrics.observe("queue", time.perf_counter() - event["received"], tag)
+            try:
+                async with self.slots:
+                    start = time.monotonic()
+                    await self.dispatch(event, tag)
+                    latency = time.monotonic() - start
+                    self.latencies[tag].append(latency)
+                    metrics.observe("dispatch", latency, tag)
+                    watchdog.beat("dispatch")
+            except Exception as e:
+                log.error(f"[{tag}] failed to dispatch {event.get('url')}: {e!r}")
+            finally:
+                self.in_flight -= 1
+                queue.task_done()
 
     async def dispatch(self, event, tag):
         """Dispatches an event to the proper channel"""
         filter = self.filters[tag]
-        content = await filter.handle_event(event)
+        context = self.contexts.get(event["id"]) if "id" in event else None
+        content = await filter.handle_event(event, context)
         if content is not None:
             for channel_id in filter.channels:
-                channel = self.discord_client.get_channel(channel_id)
-                await channel.send(content)
+                self.sender(channel_id).send(content, event["url"])
+
+
+def percentiles(values):
+    """Returns the p50, p95, p99 and max of values, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return {
+        "p50": ordered[len(ordered) // 2],
+        "p95": ordered[int(len(ordered) * 0.95)],
+        "p99": ordered[int(len(ordered) * 0.99)],
+        "max": ordered[-1],
+    }
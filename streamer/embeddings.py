@@ -1,9 +1,40 @@
-import asyncopenai.asyncopenai as openai
+import asyncio
+import collections
 import glog as log
+import itertools
 import json
+import time
 import uuid
-from qdrant_client import QdrantClient
-from qdrant_client.http.models import PointStruct, Distance, UpdateStatus, VectorParams
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from .vectorindex import LocalIndex
+
+# the embedding API and the hosted vector store are only needed by the backends that
+# use them, so the local index works without either installed.
+try:
+    import asyncopenai.asyncopenai as openai
+except ImportError:
+    openai = None
+
+try:
+    from qdrant_client import QdrantClient
+    from qdrant_client.http.models import (
+        PointStruct,
+        Distance,
+        FieldCondition,
+        Filter,
+        FilterSelector,
+        IsEmptyCondition,
+        PayloadField,
+        PayloadSchemaType,
+        Range,
+        UpdateStatus,
+        VectorParams,
+    )
+except ImportError:
+    QdrantClient = None
 
 
 def get_qdrant_api_key():
@@ -12,23 +43,119 @@ def get_qdrant_api_key():
     return secrets["api_key"]
 
 
+async def openai_embed(texts):
+    """Embeds a list of texts with a single API request."""
+    r = await openai.create_embedding(texts)
+    data = sorted(r["data"], key=lambda d: d["index"])
+    return [d["embedding"] for d in data]
+
+
+def is_rate_limited(e):
+    return getattr(e, "http_status", None) == 429 or "rate limit" in str(e).lower()
+
+
+class EmbeddingBatcher:
+    """EmbeddingBatcher collects concurrent get_embedding calls for up to max_wait
+    seconds (or max_batch_size texts) and embeds them with one multi-input request,
+    with at most max_in_flight requests outstanding.  Rate-limited requests are retried
+    with exponential backoff.  embed_fn takes a list of texts and returns their
+    embeddings in order; it defaults to the OpenAI embeddings API and can be swapped
+    for a local stub."""
+
+    def __init__(
+        self,
+        embed_fn=None,
+        max_batch_size=64,
+        max_wait=0.02,
+        max_in_flight=4,
+        retries=4,
+        backoff=1.0,
+    ):
+        self.embed_fn = embed_fn or openai_embed
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = asyncio.Queue()
+        self.task = None
+        self.running = set()
+        self.requests = 0
+
+    async def get_embedding(self, text):
+        """Returns the embedding for text, or None if it couldn't be fetched."""
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((text, future))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+        return await future
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            # texts keep collecting while every request slot is busy
+            await self.slots.acquire()
+            batch = await self._collect()
+            task = asyncio.create_task(self._embed(batch))
+            self.running.add(task)
+            task.add_done_callback(self.running.discard)
+
+    async def _embed(self, batch):
+        texts = [text for text, _ in batch]
+        embeddings = [None] * len(batch)
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.requests += 1
+                    embeddings = await self.embed_fn(texts)
+                    break
+                except Exception as e:
+                    if not is_rate_limited(e) or attempt == self.retries:
+                        log.info(f"Error getting embeddings: {e}")
+                        break
+                    delay = self.backoff * 2**attempt
+                    log.info(f"Embedding request rate limited, retrying in {delay}s")
+                    await asyncio.sleep(delay)
+        finally:
+            self.slots.release()
+
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
+
+
+_batcher = None
+
+
+def set_embedder(embed_fn, **kwargs):
+    """Replaces the batcher used by get_embedding, e.g. with a local stub embedder."""
+    global _batcher
+    _batcher = EmbeddingBatcher(embed_fn, **kwargs)
+
+
 async def get_embedding(text):
-    try:
-        r = await openai.create_embedding(text)
-    except openai.OpenAIError as e:
-        log.info(f"Error getting embedding: {e}")
-        return None
+    global _batcher
+    if _batcher is None:
+        _batcher = EmbeddingBatcher()
+    return await _batcher.get_embedding(text)
 
-    try:
-        embedding = r["data"][0]["embedding"]
-    except (KeyError, IndexError) as e:
-        log.error(f"Error getting embedding: {e}")
-    else:
-        return embedding
 
+class QdrantBackend:
+    """Vector store backend using a hosted Qdrant collection."""
 
-class EmbeddingDB:
-    def __init__(self, collection_name="hottakes"):
+    def __init__(self, collection_name):
         self.api_key = get_qdrant_api_key()
         self.client = QdrantClient(
             host="5011b95c-b05d-474e-863b-07189e741f3d.us-east-1-0.aws.cloud.qdrant.io",
@@ -47,6 +174,8 @@ class EmbeddingDB:
                 break
         if not exists:
             self._create_collection()
+        else:
+            self._create_ts_index()
         collection_info = self.client.get_collection(
             collection_name=self.collection_name
         )
@@ -57,34 +186,240 @@ class EmbeddingDB:
             collection_name=self.collection_name,
             vectors_config=VectorParams(size=1536, distance=Distance.COSINE),
         )
+        self._create_ts_index()
 
-    def add(self, text, embedding):
+    def _create_ts_index(self):
+        # retention filters and deletes on the timestamp.  points written before
+        # timestamps were added have none, so searches skip them and prune deletes
+        # them.
+        self.client.create_payload_index(
+            collection_name=self.collection_name,
+            field_name="ts",
+            field_schema=PayloadSchemaType.FLOAT,
+        )
+
+    def _point(self, text, embedding, timestamp):
         # generate a random uuid, for whatever reason qdrant doesn't seem to handle autogenerating
         # ids for us.
         id = str(uuid.uuid4())
+        return PointStruct(
+            id=id, vector=embedding, payload={"text": text, "ts": timestamp}
+        )
 
+    def add(self, text, embedding, timestamp=None):
+        timestamp = time.time() if timestamp is None else timestamp
         operation_info = self.client.upsert(
             collection_name=self.collection_name,
             wait=True,
-            points=[PointStruct(id=id, vector=embedding, payload={"text": text})],
+            points=[self._point(text, embedding, timestamp)],
         )
         assert operation_info.status == UpdateStatus.COMPLETED
 
-    def get_nearest(self, embedding):
+    def add_batch(self, items):
+        # don't wait for indexing, callers keep unindexed writes searchable themselves
+        points = [self._point(*item) for item in items]
+        self.client.upsert(
+            collection_name=self.collection_name, wait=False, points=points
+        )
+
+    def get_nearest(self, embedding, since=None):
+        query_filter = None
+        if since is not None:
+            query_filter = Filter(
+                must=[FieldCondition(key="ts", range=Range(gte=since))]
+            )
+        # the payload comes back with the hit, no separate retrieve needed
         search_result = self.client.search(
             collection_name=self.collection_name,
             limit=1,
             query_vector=embedding,
+            query_filter=query_filter,
+            with_payload=["text"],
         )
         if search_result:
-            id = search_result[0].id
-            score = search_result[0].score
-            # retrieve the text and distance
-            results = self.client.retrieve(self.collection_name, ids=[id])
-            return results[0].payload["text"], score
+            return search_result[0].payload["text"], search_result[0].score
         else:
             return None, None
 
+    def prune(self, older_than):
+        """Deletes points stored before the older_than timestamp, and points without
+        one, which searches can't see anyway."""
+        self.client.delete(
+            collection_name=self.collection_name,
+            points_selector=FilterSelector(
+                filter=Filter(
+                    should=[
+                        FieldCondition(key="ts", range=Range(lt=older_than)),
+                        IsEmptyCondition(is_empty=PayloadField(key="ts")),
+                    ]
+                )
+            ),
+            wait=False,
+        )
+
     def reset(self):
         self.client.delete_collection(self.collection_name)
         self._create_collection()
+
+
+class EmbeddingDB:
+    """EmbeddingDB stores embedded texts and finds the closest stored text to an
+    embedding.  Storage is delegated to a backend implementing add, add_batch,
+    get_nearest and reset: "local" (the default) keeps an in-process LocalIndex
+    snapshotted to <collection_name>.npz, "qdrant" uses the hosted Qdrant collection,
+    and any other object with those methods is used as is.  Extra keyword arguments are
+    passed to LocalIndex.
+
+    The async methods keep backend calls off the event loop.  They run on a single
+    worker thread, so the backend never sees concurrent calls.  queue_add buffers
+    writes and flushes them in batches of up to flush_size every flush_interval
+    seconds.  Until a buffered write is flushed, and for visibility_delay seconds
+    after that (the backend may index it lazily), search also checks it directly,
+    so back-to-back duplicates are still caught.
+
+    Every write is timestamped.  With retention set (in seconds), search ignores
+    anything older and a background job deletes it every prune_interval seconds."""
+
+    def __init__(
+        self,
+        collection_name="hottakes",
+        backend="local",
+        flush_size=64,
+        flush_interval=1.0,
+        visibility_delay=5.0,
+        retention=7 * 24 * 3600,
+        prune_interval=3600,
+        **kwargs,
+    ):
+        self.collection_name = collection_name
+        if backend == "local":
+            kwargs.setdefault("snapshot_path", f"{collection_name}.npz")
+            self.backend = LocalIndex(**kwargs)
+        elif backend == "qdrant":
+            self.backend = QdrantBackend(collection_name)
+        else:
+            self.backend = backend
+
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.visibility_delay = visibility_delay
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.prune_task = None
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix=collection_name)
+        self.pending = []  # (text, unit vector, timestamp) not yet written
+        self.flushing = {}  # batch id -> items being written
+        self.batch_ids = itertools.count()
+        self.recent = collections.deque()  # (flushed at, text, unit vector)
+        self.flush_task = None
+        self.flushes = set()
+
+    def add(self, text, embedding):
+        self.backend.add(text, embedding)
+
+    def get_nearest(self, embedding):
+        return self.backend.get_nearest(embedding, self._since())
+
+    def reset(self):
+        self.pending = []
+        self.flushing.clear()
+        self.recent.clear()
+        self.backend.reset()
+
+    async def _call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, fn, *args
+        )
+
+    def _nearest_unflushed(self, embedding):
+        now = time.monotonic()
+        while self.recent and self.recent[0][0] < now - self.visibility_delay:
+            self.recent.popleft()
+        candidates = [(t, v) for _, t, v in self.recent]
+        candidates.extend((t, v) for t, v, _ in self.pending)
+        for items in self.flushing.values():
+            candidates.extend((t, v) for t, v, _ in items)
+        if not candidates:
+            return None, None
+        query = _unit(embedding)
+        scores = np.stack([v for _, v in candidates]) @ query
+        best = int(np.argmax(scores))
+        return candidates[best][0], float(scores[best])
+
+    async def search(self, embedding):
+        """Returns the closest stored or buffered text and its similarity."""
+        text, score = await self._call(
+            self.backend.get_nearest, embedding, self._since()
+        )
+        unflushed_text, unflushed_score = self._nearest_unflushed(embedding)
+        if unflushed_score is not None and (score is None or unflushed_score > score):
+            return unflushed_text, unflushed_score
+        return text, score
+
+    def _since(self):
+        if self.retention is None:
+            return None
+        return time.time() - self.retention
+
+    def queue_add(self, text, embedding):
+        """Buffers a write for the next background flush."""
+        self.pending.append((text, _unit(embedding), time.time()))
+        if self.retention is not None and self.prune_task is None:
+            self.prune_task = asyncio.create_task(self._prune_periodically())
+        if len(self.pending) >= self.flush_size:
+            task = asyncio.create_task(self.flush())
+            self.flushes.add(task)
+            task.add_done_callback(self.flushes.discard)
+        elif self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Writes every buffered embedding to the backend."""
+        items, self.pending = self.pending, []
+        if not items:
+            return
+        # keep the batch searchable while it's being written
+        batch = next(self.batch_ids)
+        self.flushing[batch] = items
+        try:
+            await self._call(
+                self.backend.add_batch, [(t, v.tolist(), ts) for t, v, ts in items]
+            )
+        except Exception as e:
+            log.error(
+                f"[{self.collection_name}] failed to write {len(items)} embeddings: {e}"
+            )
+        finally:
+            del self.flushing[batch]
+            now = time.monotonic()
+            self.recent.extend((now, text, vector) for text, vector, _ in items)
+
+    async def prune(self):
+        """Deletes everything older than the retention window from the backend."""
+        if self.retention is not None:
+            await self._call(self.backend.prune, self._since())
+
+    async def close(self):
+        """Stops background pruning and writes out anything still buffered."""
+        if self.prune_task is not None:
+            self.prune_task.cancel()
+            self.prune_task = None
+        await self.flush()
+
+    async def _prune_periodically(self):
+        while True:
+            try:
+                await self.prune()
+            except Exception as e:
+                log.error(f"[{self.collection_name}] failed to prune: {e}")
+            await asyncio.sleep(self.prune_interval)
+
+
+def _unit(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
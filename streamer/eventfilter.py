@@ -1,5 +1,9 @@
+import asyncio
+
 import glog as log
 
+from . import metrics
+
 
 class EventFilter:
     """EventFilter is responsible for filtering tweets. It holds the twitter search filter
@@ -31,10 +35,12 @@ class EventFilter:
     def get_channels(self):
         return self.channels
 
-    async def handle_event(self, event):
+    async def handle_event(self, event, context=None):
         """Handles en event from the twitter feed.  Event is a dict containing the url and the text
         of a tweet.  Returns the content to be sent to the channel or None if the event should be
-        ignored."""
+        ignored.  The classifier and the repeat check run concurrently; the repeat check only
+        remembers the tweet once the classifier has let it through.  context is the tweet's
+        WorkContext, shared with the other filters handling it."""
         url = event["url"]
         text = event["text"]
         response = ""
@@ -43,40 +49,68 @@ class EventFilter:
             log.info(f"[{self.tag}] no text for {url}")
             return
 
-        if self.classifier:
-            try:
-                result = await self.classifier.predict(self.tag, text)
-            except Exception as e:
-                log.error(f"Got exception from classifier: {e}")
-                result = None
-
-            if result:
-                score = result["score"]
-                match = True if result["label"] == "positive" else False
-                log.info(f"[{self.tag}] classifier [{match}] {score} {url}")
-            else:
-                # in failure case just pass the tweet through
-                log.info(f"[{self.tag}] classifier failed for {url}")
-                match = True
-                score = 1.0
-
-            if not match and self.enforce_classifier:
-                return
-            response = f"Match:[{match}] Score:[{score}]"
-
+        repeat = admit = None
         if self.repeat_db:
-            try:
-                matches_repeat, text, repeat_score = await self.repeat_db.check_repeat(
-                    text
-                )
-            except:
-                log.error(f"Got exception from repeat_db: {e}")
-                matches_repeat = False
-                repeat_score = 0.0
-            if matches_repeat:
-                log.info(f"[{self.tag}] repeat skipped {repeat_score} {url}")
-                return
-            response = f"{response} Repeat:[{repeat_score}]"
+            if self.classifier:
+                admit = asyncio.get_running_loop().create_future()
+            repeat = asyncio.create_task(self.check_repeat(text, admit, context))
+
+        try:
+            if self.classifier:
+                match, score = await self.classify(url, text)
+                if not match and self.enforce_classifier:
+                    metrics.outcome(self.tag, "reject")
+                    return
+                if admit is not None:
+                    admit.set_result(True)
+                response = f"Match:[{match}] Score:[{score}]"
 
+            if repeat is not None:
+                matches_repeat, _, repeat_score = await repeat
+                if matches_repeat:
+                    log.info(f"[{self.tag}] repeat skipped {repeat_score} {url}")
+                    metrics.outcome(self.tag, "repeat")
+                    return
+                response = f"{response} Repeat:[{repeat_score}]"
+        finally:
+            # rejected (or failed), the repeat check's result isn't needed and the
+            # tweet must not be remembered
+            if repeat is not None and not repeat.done():
+                repeat.cancel()
+
+        metrics.outcome(self.tag, "match")
         response = f"{response}\n{url}"
         return response
+
+    async def classify(self, url, text):
+        """Returns (match, score) from the classifier.  If the classifier fails the
+        tweet is passed through."""
+        try:
+            with metrics.timed("classifier", self.tag):
+                result = await self.classifier.predict(self.tag, text)
+        except Exception as e:
+            log.error(f"Got exception from classifier: {e}")
+            result = None
+
+        if result:
+            score = result["score"]
+            match = True if result["label"] == "positive" else False
+            log.info(f"[{self.tag}] classifier [{match}] {score} {url}")
+        else:
+            # in failure case just pass the tweet through
+            log.info(f"[{self.tag}] classifier failed for {url}")
+            match = True
+            score = 1.0
+        return match, score
+
+    async def check_repeat(self, text, admit, context=None):
+        """Returns (is repeat, nearest text, score) from the repeat db, treating
+        failures as not a repeat."""
+        try:
+            with metrics.timed("repeat", self.tag):
+                return await self.repeat_db.check_repeat(
+                    text, admit=admit, context=context
+                )
+        except Exception as e:
+            log.error(f"Got exception from repeat_db: {e}")
+            return False, None, 0.0
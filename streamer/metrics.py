@@ -0,0 +1,62 @@
+# prometheus metrics for the streamer process.
+
+import contextlib
+import time
+
+import glog as log
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+STAGE_SECONDS = Histogram(
+    "streamer_stage_seconds",
+    "Time spent in each stage of handling a tweet.",
+    ["stage", "tag"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+    + (2.5, 5.0, 10.0, 30.0),
+)
+OUTCOMES = Counter(
+    "streamer_events",
+    "Tweets handled per tag by outcome: match, reject or repeat.",
+    ["tag", "outcome"],
+)
+QUEUE_DEPTH = Gauge(
+    "streamer_queue_depth",
+    "Events waiting in the feed queue and the dispatcher queue.",
+    ["queue"],
+)
+IN_FLIGHT = Gauge("streamer_in_flight", "Events being dispatched right now.")
+STALLS = Counter("streamer_stalls", "Stages found stalled by the watchdog.", ["stage"])
+RECOVERY_ATTEMPTS = Counter(
+    "streamer_recovery_attempts",
+    "Attempts to recover a stalled stage, e.g. stream reconnects.",
+    ["stage"],
+)
+TIME_TO_RECOVER = Histogram(
+    "streamer_time_to_recover_seconds",
+    "Time from a stage's last heartbeat before a stall to its first one after.",
+    ["stage"],
+    buckets=(30, 60, 120, 300, 600, 1200, 1800, 3600),
+)
+
+
+def observe(stage, seconds, tag=""):
+    STAGE_SECONDS.labels(stage, tag).observe(seconds)
+
+
+@contextlib.contextmanager
+def timed(stage, tag=""):
+    """Observes how long the with block takes as stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage, tag).observe(time.perf_counter() - start)
+
+
+def outcome(tag, outcome):
+    OUTCOMES.labels(tag, outcome).inc()
+
+
+def start(port=9100):
+    """Serves /metrics on port from a background thread."""
+    start_http_server(port)
+    log.info(f"Serving metrics on :{port}/metrics")
@@ -0,0 +1,178 @@
+# cheap lexical near-duplicate detection for tweets.
+
+import collections
+import hashlib
+import re
+import zlib
+
+import numpy as np
+
+_url_re = re.compile(r"https?://\S+")
+_mention_re = re.compile(r"@\w+")
+_nonword_re = re.compile(r"[^\w]+")
+
+# MinHash uses h(x) = (a * x + b) mod p with 31 bit values, so products fit in uint64.
+_PRIME = (1 << 31) - 1
+
+
+def normalize(text):
+    """Lowercases text and strips links, mentions and punctuation, which are what
+    usually differ between copies of the same tweet."""
+    text = _url_re.sub(" ", text.lower())
+    text = _mention_re.sub(" ", text)
+    return _nonword_re.sub(" ", text).strip()
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(), "little")
+
+
+class NearDuplicateIndex:
+    """NearDuplicateIndex remembers the last window texts and finds earlier copies of a
+    new text.  Exact copies (after normalization) are found by hash.  Near copies are
+    found with MinHash signatures over character shingles, bucketed with LSH into
+    bands of rows; texts sharing a bucket whose estimated Jaccard similarity is at
+    least threshold count as duplicates.
+
+    Texts that normalize to fewer than min_length characters (e.g. tweets of nothing
+    but links, mentions and emoji) have too little text left to tell apart, so they're
+    neither checked nor added; callers have to compare them some other way."""
+
+    def __init__(
+        self,
+        window=20000,
+        num_perm=128,
+        bands=32,
+        shingle_size=5,
+        threshold=0.8,
+        min_length=8,
+    ):
+        assert num_perm % bands == 0
+        self.window = window
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.threshold = threshold
+        self.min_length = min_length
+
+        rng = np.random.default_rng(1)
+        self.a = rng.integers(1, _PRIME, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, _PRIME, num_perm, dtype=np.uint64)
+
+        self.ids = collections.deque()  # insertion order, for eviction
+        self.next_id = 0
+        self.docs = {}  # id -> (text, exact hash, signature)
+        self.exact = {}  # exact hash -> id
+        self.buckets = collections.defaultdict(set)  # (band, band hash) -> ids
+
+    def __len__(self):
+        return len(self.docs)
+
+    def _shingles(self, normalized):
+        n = self.shingle_size
+        if len(normalized) <= n:
+            return {normalized}
+        return {normalized[i : i + n] for i in range(len(normalized) - n + 1)}
+
+    def _signature(self, normalized):
+        hashes = np.fromiter(
+            (
+                zlib.crc32(s.encode("utf-8")) % _PRIME
+                for s in self._shingles(normalized)
+            ),
+            dtype=np.uint64,
+        )
+        permuted = (np.outer(self.a, hashes) + self.b[:, None]) % _PRIME
+        return permuted.min(axis=1)
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            rows = signature[band * self.rows : (band + 1) * self.rows]
+            yield band, rows.tobytes()
+
+    def fingerprint(self, text):
+        """Returns the (exact hash, signature) check and add use for text, so a caller
+        can check now and add later without computing it twice, or None if text is
+        too short to index."""
+        normalized = normalize(text)
+        if len(normalized) < self.min_length:
+            return None
+        exact = _hash(normalized.encode("utf-8"))
+        if exact in self.exact:
+            # exact copies never need a signature
+            return exact, None
+        return exact, self._signature(normalized)
+
+    def check(self, text, fingerprint=None):
+        """Returns ("exact", earlier text, 1.0), ("near", earlier text, estimated
+        similarity) or (None, None, None)."""
+        fingerprint = fingerprint or self.fingerprint(text)
+        if fingerprint is None:
+            return None, None, None
+        exact, signature = fingerprint
+        if exact in self.exact:
+            return "exact", self.docs[self.exact[exact]][0], 1.0
+        if signature is None:
+            signature = self._signature(normalize(text))
+
+        candidates = set()
+        for key in self._band_keys(signature):
+            candidates.update(self.buckets.get(key, ()))
+        if not candidates:
+            return None, None, None
+        candidates = list(candidates)
+        signatures = np.stack([self.docs[id][2] for id in candidates])
+        scores = (signatures == signature).mean(axis=1)
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return "near", self.docs[candidates[best]][0], float(scores[best])
+        return None, None, None
+
+    def compare(self, a, b):
+        """Returns ("exact", 1.0), ("near", estimated similarity) or (None, None) for
+        two fingerprints, e.g. of texts not added yet."""
+        if a[0] == b[0]:
+            return "exact", 1.0
+        if a[1] is None or b[1] is None:
+            return None, None
+        score = float((a[1] == b[1]).mean())
+        if score >= self.threshold:
+            return "near", score
+        return None, None
+
+    def add(self, text, fingerprint=None):
+        fingerprint = fingerprint or self.fingerprint(text)
+        if fingerprint is None:
+            return
+        exact, signature = fingerprint
+        if signature is None:
+            signature = self._signature(normalize(text))
+        id = self.next_id
+        self.next_id += 1
+        self.docs[id] = (text, exact, signature)
+        self.exact[exact] = id
+        for key in self._band_keys(signature):
+            self.buckets[key].add(id)
+        self.ids.append(id)
+        while len(self.ids) > self.window:
+            self._evict(self.ids.popleft())
+
+    def check_and_add(self, text):
+        """Checks text against the window and adds it if it's new.  Duplicates aren't
+        added, the earlier copy already stands for them."""
+        fingerprint = self.fingerprint(text)
+        result = self.check(text, fingerprint)
+        if result[0] is None:
+            self.add(text, fingerprint)
+        return result
+
+    def _evict(self, id):
+        text, exact, signature = self.docs.pop(id)
+        if self.exact.get(exact) == id:
+            del self.exact[exact]
+        for key in self._band_keys(signature):
+            bucket = self.buckets[key]
+            bucket.discard(id)
+            if not bucket:
+                del self.buckets[key]
@@ -0,0 +1,34 @@
+# records raw stream payloads so they can be replayed later.
+
+import atexit
+import json
+import time
+
+
+class Recorder:
+    """Recorder appends raw stream payloads to a JSONL file, one {"t": receive time,
+    "data": payload} object per line."""
+
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self.file = open(path, "a", encoding="utf-8")
+        atexit.register(self.close)
+
+    def record(self, data):
+        if isinstance(data, bytes):
+            data = data.decode("utf-8")
+        self.file.write(json.dumps({"t": self.clock(), "data": data}) + "\n")
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_recording(path):
+    """Yields (receive time, raw payload) pairs from a recording."""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record["t"], record["data"]
@@ -1,16 +1,127 @@
-from . import embeddings
+import asyncio
+import collections
+
+import glog as log
+import numpy as np
+
+from . import embeddings, metrics
+from .nearduplicate import NearDuplicateIndex
 
 
 class RepeatDB:
-    def __init__(self, tag, threshold=0.86):
-        self.db = embeddings.EmbeddingDB(collection_name=tag + "_repeats")
+    """RepeatDB decides whether a tweet repeats one seen recently.  A lexical prefilter
+    catches exact and near-verbatim copies without any network calls; only texts it
+    doesn't recognize are embedded and looked up in the EmbeddingDB.  Extra keyword
+    arguments are passed to the EmbeddingDB."""
+
+    def __init__(
+        self, tag, threshold=0.86, backend="local", prefilter_window=20000, **kwargs
+    ):
+        self.tag = tag
+        self.db = embeddings.EmbeddingDB(
+            collection_name=tag + "_repeats", backend=backend, **kwargs
+        )
         self.threshold = threshold
+        self.prefilter = NearDuplicateIndex(window=prefilter_window)
+        self.counts = collections.Counter()
+        self.pending = []  # _Pending checks, oldest first
+
+    def stats(self):
+        """Returns per-stage counts and the fraction of checks that needed no
+        embedding."""
+        stats = dict(self.counts)
+        checked = self.counts["checked"]
+        avoided = self.counts["exact"] + self.counts["near"]
+        stats["embedding_avoided"] = avoided / checked if checked else 0.0
+        return stats
+
+    async def check_repeat(self, text, admit=None, context=None):
+        """Returns (is repeat, nearest earlier text, similarity) and remembers text.
+        If admit is given, an awaitable resolving to whether text should be kept, the
+        check runs straight away but text is only remembered once admit is true.
+        This lets the check run alongside a classifier without letting rejected
+        tweets into the index.  Until then text is pending: later checks that match
+        it wait to see whether it's admitted, so a copy arriving while the original
+        is still being classified is caught.  If context is the tweet's WorkContext,
+        the embedding is shared with the other filters checking the same tweet."""
+        self.counts["checked"] += 1
+        if self.counts["checked"] % 1000 == 0:
+            log.info(f"[{self.tag}] repeat stats: {self.stats()}")
+
+        fingerprint = self.prefilter.fingerprint(text)
+        kind, nearest, score = self.prefilter.check(text, fingerprint)
+        if kind is not None:
+            self.counts[kind] += 1
+            return True, nearest, score
 
-    async def check_repeat(self, text):
-        embedding = await embeddings.get_embedding(text)
-        text, score = self.db.get_nearest(embedding)
-        self.db.add(text, embedding)
+        earlier = list(self.pending)
+        entry = _Pending(text, fingerprint)
+        self.pending.append(entry)
+        admitted = False
+        try:
+            self.counts["embedded"] += 1
+            with metrics.timed("embedding", self.tag):
+                if context is not None:
+                    embedding = await context.get(
+                        "embedding", embeddings.get_embedding, text
+                    )
+                else:
+                    embedding = await embeddings.get_embedding(text)
+            entry.embedded.set_result(embedding)
+            if embedding is not None:
+                with metrics.timed("vector_search", self.tag):
+                    nearest, score = await self.db.search(embedding)
+
+            if admit is not None and not await admit:
+                return False, None, None
+            for other in earlier:
+                kind, other_score = await self._match_pending(entry, other)
+                if kind is not None and await asyncio.shield(other.settled):
+                    self.counts[kind] += 1
+                    return True, other.text, other_score
+
+            self.prefilter.add(text, fingerprint)
+            if embedding is not None:
+                self.db.queue_add(text, embedding)
+            admitted = True
+        finally:
+            self.pending.remove(entry)
+            if not entry.embedded.done():
+                entry.embedded.set_result(None)
+            entry.settled.set_result(admitted)
 
         if score is None:
             return False, None, None
-        return score > self.threshold, text, score
+        if score > self.threshold:
+            self.counts["semantic"] += 1
+        return score > self.threshold, nearest, score
+
+    async def _match_pending(self, entry, other):
+        """Returns (kind, similarity) if entry repeats the pending other, else
+        (None, None)."""
+        if entry.fingerprint is not None and other.fingerprint is not None:
+            kind, score = self.prefilter.compare(entry.fingerprint, other.fingerprint)
+            if kind is not None:
+                return kind, score
+        mine = entry.embedded.result()
+        if mine is None:
+            return None, None
+        theirs = await asyncio.shield(other.embedded)
+        if theirs is None:
+            return None, None
+        mine, theirs = np.asarray(mine), np.asarray(theirs)
+        score = float(mine @ theirs / (np.linalg.norm(mine) * np.linalg.norm(theirs)))
+        if score > self.threshold:
+            return "semantic", score
+        return None, None
+
+
+class _Pending:
+    """A text being checked that hasn't been admitted or rejected yet."""
+
+    def __init__(self, text, fingerprint):
+        loop = asyncio.get_running_loop()
+        self.text = text
+        self.fingerprint = fingerprint
+        self.embedded = loop.create_future()  # its embedding, or None
+        self.settled = loop.create_future()  # whether it was remembered
@@ -0,0 +1,374 @@
+# replays recorded stream payloads through the dispatcher with local stand-ins for
+# discord, the classifier, the embedding API and the vector store, and reports
+# throughput, per-stage latency and peak memory.
+#
+# record with TwitterFeed(record_path=...) (STREAMER_RECORD=path for main.py), then:
+#   python -m streamer.replay recording.jsonl [--speed 1|10|max] [--baseline b.json]
+#   python -m streamer.replay --synthetic 2000 --speed max --save b.json
+
+import argparse
+import asyncio
+import collections
+import json
+import random
+import resource
+import sys
+import time
+import zlib
+
+import glog as log
+import numpy as np
+
+from . import embeddings
+from .dispatcher import Dispatcher, percentiles
+from .eventfilter import EventFilter
+from .recorder import read_recording
+from .repeatdb import RepeatDB
+from .twitterfeed import parse_payload
+from .vectorindex import LocalIndex
+
+_END = object()
+
+
+class Timings:
+    """Timings collects durations per stage."""
+
+    def __init__(self):
+        self.values = collections.defaultdict(list)
+
+    def add(self, stage, seconds):
+        self.values[stage].append(seconds)
+
+    def report(self):
+        return {
+            stage: {p: round(value, 4) for p, value in percentiles(values).items()}
+            for stage, values in self.values.items()
+        }
+
+
+class ReplayFeed:
+    """ReplayFeed plays recorded payloads like a TwitterFeed, at speed times the
+    recorded rate, or as fast as the dispatcher takes them if speed is None."""
+
+    def __init__(self, records, speed=None, queue_size=1000):
+        self.records = records
+        self.speed = speed
+        self.queue = asyncio.Queue(queue_size)
+        self.received = {}  # url -> when the payload arrived
+        self.events = 0
+        self.task = None
+
+    async def set_rules(self, rules):
+        pass
+
+    def get_qsize(self):
+        return self.queue.qsize()
+
+    def __aiter__(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self._play())
+        return self
+
+    async def __anext__(self):
+        item = await self.queue.get()
+        if item is _END:
+            raise StopAsyncIteration
+        return item
+
+    async def _play(self):
+        start = time.monotonic()
+        first = None
+        for t, data in self.records:
+            if self.speed:
+                first = t if first is None else first
+                delay = (t - first) / self.speed - (time.monotonic() - start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            try:
+                event, tags = parse_payload(data)
+            except KeyError:
+                continue
+            self.events += 1
+            self.received.setdefault(event["url"], time.monotonic())
+            for tag in tags:
+                await self.queue.put((event, tag))
+        await self.queue.put(_END)
+
+
+class FakeMessage:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeChannel:
+    def __init__(self, latency, feed, timings):
+        self.latency = latency
+        self.feed = feed
+        self.timings = timings
+        self.sent = 0
+
+    async def send(self, content):
+        start = time.monotonic()
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        self.timings.add("send", now - start)
+        for line in content.split("\n"):
+            if line in self.feed.received:
+                self.timings.add("end_to_end", now - self.feed.received[line])
+        self.sent += 1
+        return FakeMessage(self.sent)
+
+
+class FakeDiscordClient:
+    def __init__(self, latency, feed, timings):
+        self.channels = collections.defaultdict(
+            lambda: FakeChannel(latency, feed, timings)
+        )
+
+    def get_channel(self, channel_id):
+        return self.channels[channel_id]
+
+
+class FakeClassifier:
+    """Labels about positive_rate of the texts positive, after latency seconds."""
+
+    def __init__(self, latency, timings, positive_rate=0.7):
+        self.latency = latency
+        self.timings = timings
+        self.positive_rate = positive_rate
+
+    async def predict(self, tag, text):
+        start = time.monotonic()
+        await asyncio.sleep(self.latency)
+        positive = zlib.crc32(text.encode()) % 100 < self.positive_rate * 100
+        self.timings.add("classifier", time.monotonic() - start)
+        return {"label": "positive" if positive else "negative", "score": 0.9}
+
+
+class FakeEmbedder:
+    """Embeds a batch of texts after latency seconds, the same text always to the
+    same vector."""
+
+    def __init__(self, latency, timings, dim=1536):
+        self.latency = latency
+        self.timings = timings
+        self.dim = dim
+
+    async def __call__(self, texts):
+        start = time.monotonic()
+        await asyncio.sleep(self.latency)
+        vectors = [
+            np.random.default_rng(zlib.crc32(text.encode())).normal(size=self.dim)
+            for text in texts
+        ]
+        self.timings.add("embedding_request", time.monotonic() - start)
+        return [v.tolist() for v in vectors]
+
+
+class SlowIndex(LocalIndex):
+    """A LocalIndex that takes latency seconds per call, like a remote store."""
+
+    def __init__(self, latency, timings, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.timings = timings
+
+    def get_nearest(self, embedding, since=None):
+        start = time.monotonic()
+        time.sleep(self.latency)
+        result = super().get_nearest(embedding, since)
+        self.timings.add("vector_search", time.monotonic() - start)
+        return result
+
+    def add_batch(self, items):
+        time.sleep(self.latency)
+        super().add_batch(items)
+
+
+class TimedDispatcher(Dispatcher):
+    def __init__(self, *args, timings, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timings = timings
+        self.dispatched = 0
+        self.last_done = None
+
+    async def dispatch(self, event, tag):
+        start = time.monotonic()
+        await super().dispatch(event, tag)
+        self.last_done = time.monotonic()
+        self.timings.add("dispatch", self.last_done - start)
+        self.dispatched += 1
+
+
+def synthesize(n, rate=50.0, tags=("ai", "whitepill", "eacc"), repeat=0.1, seed=1):
+    """Returns n recorded payloads arriving at rate per second, each matching one or
+    two of tags, with about a repeat fraction re-posting an earlier text."""
+    rng = random.Random(seed)
+    words = [f"word{i}" for i in range(500)]
+    texts = []
+    records = []
+    t = 1e9
+    for id in range(1, n + 1):
+        if texts and rng.random() < repeat:
+            text = rng.choice(texts)
+        else:
+            text = " ".join(rng.choices(words, k=rng.randint(8, 40)))
+            texts.append(text)
+        matched = rng.sample(tags, rng.choice([1, 1, 1, 2]))
+        payload = {
+            "data": {"id": str(id), "text": text},
+            "matching_rules": [{"id": tag, "tag": tag} for tag in matched],
+        }
+        records.append((t, json.dumps(payload)))
+        t += rng.expovariate(rate)
+    return records
+
+
+def recording_tags(records):
+    tags = set()
+    for _, data in records:
+        try:
+            tags.update(parse_payload(data)[1])
+        except KeyError:
+            pass
+    return sorted(tags)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def replay(
+    records,
+    speed=None,
+    classifier_latency=0.02,
+    embedding_latency=0.1,
+    store_latency=0.002,
+    send_latency=0.05,
+    channel_rate=(5, 5.0),
+    num_workers=32,
+):
+    """Replays records through a Dispatcher with a classifier and repeat check on
+    every tag, and returns the report."""
+    timings = Timings()
+    embeddings.set_embedder(FakeEmbedder(embedding_latency, timings))
+    feed = ReplayFeed(records, speed)
+    dispatcher = TimedDispatcher(
+        FakeDiscordClient(send_latency, feed, timings),
+        feed,
+        num_workers=num_workers,
+        channel_rate=channel_rate,
+        timings=timings,
+    )
+    repeat_dbs = []
+    for channel_id, tag in enumerate(recording_tags(records), 1):
+        repeat_db = RepeatDB(
+            tag, backend=SlowIndex(store_latency, timings), retention=None
+        )
+        repeat_dbs.append(repeat_db)
+        dispatcher.add_filter(
+            EventFilter(
+                tag,
+                [channel_id],
+                classifier=FakeClassifier(classifier_latency, timings),
+                repeat_db=repeat_db,
+            )
+        )
+
+    start = time.monotonic()
+    await dispatcher.monitor_feed()
+    drained = time.monotonic()
+    for repeat_db in repeat_dbs:
+        await repeat_db.db.close()
+
+    processed = (dispatcher.last_done or drained) - start
+    return {
+        "events": feed.events,
+        "dispatched": dispatcher.dispatched,
+        "seconds": round(drained - start, 3),
+        "events_per_s": round(feed.events / processed, 1) if processed else None,
+        "stages": timings.report(),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def compare(report, baseline):
+    """Returns lines comparing a report against a baseline report."""
+    lines = []
+
+    def line(name, new, old, higher_is_better=False):
+        if new is None or not old:
+            return
+        change = new / old - 1
+        better = change > 0 if higher_is_better else change < 0
+        mark = "better" if better else "worse" if change else "same"
+        lines.append(f"{name:>28}: {old:10.4g} -> {new:10.4g} ({change:+.1%}, {mark})")
+
+    line("events/s", report["events_per_s"], baseline["events_per_s"], True)
+    for stage, stats in report["stages"].items():
+        old = baseline["stages"].get(stage)
+        if stats and old:
+            for p in ["p50", "p95", "p99"]:
+                line(f"{stage} {p}", stats[p], old[p])
+    line("peak rss mb", report["peak_rss_mb"], baseline["peak_rss_mb"])
+    return lines
+
+
+def parse_speed(value):
+    return None if value == "max" else float(value)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog="python -m streamer.replay")
+    parser.add_argument("recording", nargs="?", help="a recorded JSONL file")
+    parser.add_argument("--synthetic", type=int, help="replay n generated tweets")
+    parser.add_argument("--speed", type=parse_speed, default=None, help="1, 10 or max")
+    parser.add_argument("--classifier-latency", type=float, default=0.02)
+    parser.add_argument("--embedding-latency", type=float, default=0.1)
+    parser.add_argument("--store-latency", type=float, default=0.002)
+    parser.add_argument("--send-latency", type=float, default=0.05)
+    parser.add_argument(
+        "--channel-rate",
+        type=float,
+        nargs=2,
+        default=(5, 5.0),
+        metavar=("MESSAGES", "SECONDS"),
+    )
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--baseline", help="compare against this report")
+    parser.add_argument("--save", help="write the report here, e.g. as a baseline")
+    args = parser.parse_args(argv)
+    # the per-tweet info logs would swamp the report
+    log.setLevel("WARNING")
+
+    if args.synthetic:
+        records = synthesize(args.synthetic)
+    elif args.recording:
+        records = list(read_recording(args.recording))
+    else:
+        parser.error("pass a recording or --synthetic n")
+
+    report = asyncio.run(
+        replay(
+            records,
+            speed=args.speed,
+            classifier_latency=args.classifier_latency,
+            embedding_latency=args.embedding_latency,
+            store_latency=args.store_latency,
+            send_latency=args.send_latency,
+            channel_rate=tuple(args.channel_rate),
+            num_workers=args.workers,
+        )
+    )
+    print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            print("\n".join(compare(report, json.load(f))))
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,104 @@
+# rate limited, coalescing outbound message queues for discord channels.
+
+import asyncio
+import collections
+import time
+
+import glog as log
+
+from . import metrics, watchdog
+
+# discord allows 2000 characters per message, and (currently) about 5 messages per 5
+# seconds per channel before it starts answering with 429s.
+MAX_MESSAGE_LENGTH = 2000
+CHANNEL_RATE = (5, 5.0)
+
+
+class TokenBucket:
+    """TokenBucket allows capacity actions per period seconds, refilling continuously,
+    so up to capacity actions can happen back to back after a quiet spell."""
+
+    def __init__(self, capacity=CHANNEL_RATE[0], period=CHANNEL_RATE[1], clock=None):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.clock = clock or time.monotonic
+        self.tokens = float(capacity)
+        self.updated = self.clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Returns how many seconds until a token is available."""
+        self._refill()
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    async def acquire(self):
+        while (delay := self.delay()) > 0:
+            await asyncio.sleep(delay)
+        self.take()
+
+
+class ChannelSender:
+    """ChannelSender sends messages to one channel at the rate its bucket allows.
+    Messages queue up while the bucket is empty, and when a token frees up everything
+    queued is sent together, as few messages as fit in max_length characters.  If
+    messages is a MessageIndex, each sent message is recorded with the urls of every
+    tweet in it.  Reactions on a combined message aren't saved as annotations, since
+    they can't say which tweet they're about."""
+
+    def __init__(self, channel, bucket=None, messages=None, max_length=None):
+        self.channel = channel
+        self.bucket = bucket or TokenBucket()
+        self.messages = messages
+        self.max_length = max_length or MAX_MESSAGE_LENGTH
+        self.queue = collections.deque()  # (content, url, queued at)
+        self.latencies = collections.deque(maxlen=1000)
+        self.task = None
+
+    def qsize(self):
+        return len(self.queue)
+
+    def send(self, content, url):
+        """Queues content, which links the tweet at url, for sending."""
+        self.queue.append((content, url, time.monotonic()))
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def drain(self):
+        """Waits until everything queued so far has been sent."""
+        while self.task is not None and not self.task.done():
+            await asyncio.shield(self.task)
+
+    def _next_batch(self):
+        batch = [self.queue.popleft()]
+        length = len(batch[0][0])
+        while self.queue and length + 1 + len(self.queue[0][0]) <= self.max_length:
+            length += 1 + len(self.queue[0][0])
+            batch.append(self.queue.popleft())
+        return batch
+
+    async def _run(self):
+        while self.queue:
+            await self.bucket.acquire()
+            batch = self._next_batch()
+            content = "\n".join(content for content, _, _ in batch)
+            try:
+                with metrics.timed("send"):
+                    message = await self.channel.send(content)
+            except Exception as e:
+                log.error(f"failed to send {len(batch)} tweets to {self.channel}: {e}")
+                continue
+            watchdog.beat("send")
+            now = time.monotonic()
+            for _, _, queued in batch:
+                self.latencies.append(now - queued)
+                metrics.observe("send_wait", now - queued)
+            if self.messages is not None and message is not None:
+                self.messages.record(message.id, [url for _, url, _ in batch])
@@ -1,5 +1,6 @@
 import pytest
 import asyncio
+import time
 from streamer.eventfilter import EventFilter
 from streamer.dispatcher import Dispatcher
 
@@ -14,6 +15,12 @@ class FakeDiscordClient:
         return self.channels[channel_id]
 
 
+class FakeMessage:
+    def __init__(self, id, content):
+        self.id = id
+        self.content = content
+
+
 class FakeChannel:
     def __init__(self, channel_id):
         self.channel_id = channel_id
@@ -23,12 +30,22 @@ class FakeChannel:
         print(f"Sending message to channel {self.channel_id}: {content}")
         self.messages.append(content)
         print(f"Messages: {self.messages}")
+        return FakeMessage(self.channel_id * 1000 + len(self.messages), content)
+
+
+class FakeMessageIndex:
+    def __init__(self):
+        self.entries = {}
+
+    def record(self, message_id, urls):
+        self.entries[message_id] = urls
 
 
 class FakeFeed:
-    def __init__(self, calls=1):
+    def __init__(self, calls=1, tag="test"):
         self.rules = []
         self.calls = calls
+        self.tag = tag
 
     async def set_rules(self, rules):
         self.rules = rules
@@ -39,11 +56,16 @@ class FakeFeed:
     async def __anext__(self):
         if self.calls:
             self.calls -= 1
-            return {"url": "http://foo.com", "text": "foo"}, "test"
+            return {"url": "http://foo.com", "text": "foo"}, self.tag
         else:
             raise StopAsyncIteration
 
 
+def sent_urls(channel):
+    # several tweets may share a message once a backlog builds
+    return [line for m in channel.messages for line in m.split("\n") if "://" in line]
+
+
 def get_event_filter(channel_id=1):
     return EventFilter(
         tag="test",
@@ -65,7 +87,7 @@ async def test_monitor_feed():
     await dispatcher.monitor_feed()
     await asyncio.sleep(0.1)
     channel = discord.get_channel(1)
-    assert len(channel.messages) == 5
+    assert len(sent_urls(channel)) == 5
 
 
 @pytest.mark.asyncio
@@ -81,8 +103,8 @@ async def test_multichannel_dispatch():
     await asyncio.sleep(0.1)
     channel1 = discord.get_channel(1)
     channel2 = discord.get_channel(2)
-    assert len(channel1.messages) == 5
-    assert len(channel2.messages) == 5
+    assert len(sent_urls(channel1)) == 5
+    assert len(sent_urls(channel2)) == 5
 
 
 @pytest.mark.asyncio
@@ -101,5 +123,137 @@ async def test_multiple_filters():
     await asyncio.sleep(0.1)
     channel1 = discord.get_channel(1)
     channel2 = discord.get_channel(2)
-    assert len(channel1.messages) == 5
-    assert len(channel2.messages) == 0
+    assert len(sent_urls(channel1)) == 5
+    assert len(sent_urls(channel2)) == 0
+
+
+@pytest.mark.asyncio
+async def test_records_sent_messages():
+    discord = FakeDiscordClient()
+    messages = FakeMessageIndex()
+    dispatcher = Dispatcher(discord, FakeFeed(2), messages=messages)
+    dispatcher.add_filter(get_event_filter())
+
+    await dispatcher.monitor_feed()
+    await asyncio.sleep(0.1)
+    assert list(messages.entries)[0] == 1001
+    urls = [url for urls in messages.entries.values() for url in urls]
+    assert urls == ["http://foo.com", "http://foo.com"]
+
+
+class SlowClassifier:
+    def __init__(self, delay):
+        self.delay = delay
+
+    async def predict(self, tag, text):
+        await asyncio.sleep(self.delay)
+        return {"label": "positive", "score": 1.0}
+
+
+@pytest.mark.asyncio
+async def test_burst_is_bounded():
+    discord = FakeDiscordClient()
+    # a 10x burst: 10 times more events than the pool has workers, each slow
+    dispatcher = Dispatcher(
+        discord,
+        FakeFeed(320),
+        num_workers=32,
+        tag_concurrency=8,
+        channel_rate=(1000, 1.0),
+    )
+    ef = get_event_filter()
+    ef.classifier = SlowClassifier(0.01)
+    dispatcher.add_filter(ef)
+
+    peak = 0
+
+    async def watch():
+        nonlocal peak
+        while True:
+            peak = max(peak, dispatcher.in_flight)
+            await asyncio.sleep(0.001)
+
+    watcher = asyncio.create_task(watch())
+    await dispatcher.monitor_feed()
+    watcher.cancel()
+
+    assert len(sent_urls(discord.get_channel(1))) == 320
+    assert 0 < peak <= 8
+    assert dispatcher.stats()["latency"]["test"]["max"] < 0.1
+
+
+@pytest.mark.asyncio
+async def test_unknown_tag_does_not_kill_workers():
+    discord = FakeDiscordClient()
+    dispatcher = Dispatcher(discord, FakeFeed(3, tag="unknown"), num_workers=1)
+    dispatcher.add_filter(get_event_filter())
+    await dispatcher.monitor_feed()
+    assert dispatcher.qsize() == 0
+    assert not discord.channels
+
+
+@pytest.mark.asyncio
+async def test_backlog_is_coalesced():
+    discord = FakeDiscordClient()
+    messages = FakeMessageIndex()
+    # one message per 50ms, so everything after the first has to wait
+    dispatcher = Dispatcher(
+        discord, FakeFeed(50), messages=messages, channel_rate=(1, 0.05)
+    )
+    dispatcher.add_filter(get_event_filter())
+    await dispatcher.monitor_feed()
+
+    channel = discord.get_channel(1)
+    assert len(sent_urls(channel)) == 50
+    assert len(channel.messages) < 50
+    assert all(len(m) <= 2000 for m in channel.messages)
+    assert sum(len(urls) for urls in messages.entries.values()) == 50
+    stats = dispatcher.stats()["channels"][1]
+    assert stats["queue_depth"] == 0
+    assert stats["send_latency"]["max"] > 0
+
+
+class FeedOf:
+    """Feeds the given (event, tag) pairs, stamped with when they were read."""
+
+    def __init__(self, events):
+        self.events = iter(events)
+        self.read = {}
+
+    async def set_rules(self, rules):
+        pass
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            event, tag = next(self.events)
+        except StopIteration:
+            raise StopAsyncIteration
+        self.read[event["url"]] = time.monotonic()
+        return event, tag
+
+
+@pytest.mark.asyncio
+async def test_slow_tag_does_not_hold_up_others():
+    discord = FakeDiscordClient()
+    events = [({"url": f"http://slow/{i}", "text": "x"}, "slow") for i in range(100)]
+    events += [({"url": f"http://fast/{i}", "text": "x"}, "fast") for i in range(10)]
+    feed = FeedOf(events)
+    dispatcher = Dispatcher(
+        discord, feed, num_workers=32, tag_concurrency=8, channel_rate=(1000, 1.0)
+    )
+    for tag, delay, channel in [("slow", 0.2, 1), ("fast", 0.0, 2)]:
+        ef = get_event_filter()
+        ef.tag, ef.channels, ef.classifier = tag, [channel], SlowClassifier(delay)
+        dispatcher.add_filter(ef)
+
+    task = asyncio.create_task(dispatcher.monitor_feed())
+    start = time.monotonic()
+    while len(sent_urls(discord.get_channel(2))) < 10:
+        await asyncio.sleep(0.01)
+    assert time.monotonic() - start < 0.5
+    assert dispatcher.in_flight == 8
+    assert dispatcher.stats()["latency"]["fast"]["max"] < 0.1
+    task.cancel()
@@ -0,0 +1,44 @@
+import asyncio
+import pytest
+from streamer.embeddings import EmbeddingBatcher
+
+
+class StubEmbedder:
+    def __init__(self, failures=0, error="Rate limit reached"):
+        self.calls = []
+        self.failures = failures
+        self.error = error
+
+    async def __call__(self, texts):
+        self.calls.append(list(texts))
+        await asyncio.sleep(0.01)
+        if self.failures:
+            self.failures -= 1
+            raise Exception(self.error)
+        return [[float(len(text))] for text in texts]
+
+
+@pytest.mark.asyncio
+async def test_batches_concurrent_calls():
+    embedder = StubEmbedder()
+    batcher = EmbeddingBatcher(embedder, max_batch_size=4, max_in_flight=2)
+    texts = ["a" * i for i in range(1, 11)]
+    results = await asyncio.gather(*[batcher.get_embedding(t) for t in texts])
+    assert results == [[float(i)] for i in range(1, 11)]
+    assert [len(call) for call in embedder.calls] == [4, 4, 2]
+
+
+@pytest.mark.asyncio
+async def test_retries_rate_limit():
+    embedder = StubEmbedder(failures=2)
+    batcher = EmbeddingBatcher(embedder, backoff=0.001)
+    assert await batcher.get_embedding("abc") == [3.0]
+    assert len(embedder.calls) == 3
+
+
+@pytest.mark.asyncio
+async def test_other_errors_return_none():
+    embedder = StubEmbedder(failures=1, error="bad request")
+    batcher = EmbeddingBatcher(embedder, backoff=0.001)
+    assert await batcher.get_embedding("abc") is None
+    assert len(embedder.calls) == 1
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 from streamer.eventfilter import EventFilter
 
@@ -17,11 +19,26 @@ class FakeClassifier:
 class FakeRepeatDB:
     def __init__(self, result=False):
         self.result = result
+        self.remembered = []
 
-    async def check_repeat(self, text):
+    async def check_repeat(self, text, admit=None, context=None):
+        if admit is None or await admit:
+            self.remembered.append(text)
         return self.result, None, None
 
 
+class SlowClassifier(FakeClassifier):
+    async def predict(self, tag, text):
+        await asyncio.sleep(0.05)
+        return await super().predict(tag, text)
+
+
+class SlowRepeatDB(FakeRepeatDB):
+    async def check_repeat(self, text, admit=None, context=None):
+        await asyncio.sleep(0.05)
+        return await super().check_repeat(text, admit, context)
+
+
 def fake_event():
     return {
         "url": "htttps://invalid/1234",
@@ -83,3 +100,101 @@ async def test_classifier_repeat():
     event = fake_event()
     result = await ef.handle_event(event)
     assert not result
+
+
+@pytest.mark.asyncio
+async def test_classifier_and_repeat_run_concurrently():
+    repeat_db = SlowRepeatDB(False)
+    ef = EventFilter(
+        "tag", channels=[], filter="", repeat_db=repeat_db, classifier=SlowClassifier()
+    )
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    result = await ef.handle_event(fake_event())
+    assert result
+    assert loop.time() - start < 0.09
+    assert repeat_db.remembered == ["some text"]
+
+
+@pytest.mark.asyncio
+async def test_rejected_tweet_not_remembered():
+    repeat_db = FakeRepeatDB(False)
+    ef = EventFilter(
+        "tag",
+        channels=[],
+        filter="",
+        repeat_db=repeat_db,
+        classifier=SlowClassifier(result="negative"),
+    )
+    assert not await ef.handle_event(fake_event())
+    assert repeat_db.remembered == []
+
+
+@pytest.mark.asyncio
+async def test_unenforced_rejection_is_remembered():
+    repeat_db = FakeRepeatDB(False)
+    ef = EventFilter(
+        "tag",
+        channels=[],
+        filter="",
+        repeat_db=repeat_db,
+        classifier=FakeClassifier(result="negative"),
+        enforce_classifier=False,
+    )
+    assert await ef.handle_event(fake_event())
+    assert repeat_db.remembered == ["some text"]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_copies_posted_once(monkeypatch):
+    from streamer import embeddings
+    from streamer.repeatdb import RepeatDB
+    from streamer.tests.test_repeatdb import fake_embedding
+
+    async def get_embedding(text):
+        return fake_embedding(text)
+
+    monkeypatch.setattr(embeddings, "get_embedding", get_embedding)
+    event_filter = EventFilter(
+        "ai",
+        [],
+        repeat_db=RepeatDB("ai", snapshot_path=None),
+        classifier=SlowClassifier(),
+    )
+    text = "OpenAI releases a new model"
+    responses = await asyncio.gather(
+        event_filter.handle_event({"url": "u1", "text": text}),
+        event_filter.handle_event({"url": "u2", "text": text}),
+    )
+    assert responses[0] is not None and responses[0].endswith("u1")
+    assert responses[1] is None
+    assert not event_filter.repeat_db.pending
+
+
+@pytest.mark.asyncio
+async def test_copy_of_rejected_tweet_still_checked(monkeypatch):
+    from streamer import embeddings
+    from streamer.repeatdb import RepeatDB
+    from streamer.tests.test_repeatdb import fake_embedding
+
+    async def get_embedding(text):
+        return fake_embedding(text)
+
+    class FirstRejected(SlowClassifier):
+        async def predict(self, tag, text):
+            result = await super().predict(tag, text)
+            self.result = "positive"
+            return result
+
+    monkeypatch.setattr(embeddings, "get_embedding", get_embedding)
+    repeat_db = RepeatDB("ai", snapshot_path=None)
+    event_filter = EventFilter(
+        "ai", [], repeat_db=repeat_db, classifier=FirstRejected("negative")
+    )
+    text = "OpenAI releases a new model"
+    first = asyncio.create_task(event_filter.handle_event({"url": "u1", "text": text}))
+    await asyncio.sleep(0.01)
+    second = asyncio.create_task(event_filter.handle_event({"url": "u2", "text": text}))
+    assert await first is None
+    # the original was rejected, so the copy isn't a repeat of it
+    assert (await second).endswith("u2")
@@ -0,0 +1,45 @@
+import pytest
+from prometheus_client import REGISTRY
+from streamer.dispatcher import Dispatcher
+from streamer.eventfilter import EventFilter
+from streamer.tests.test_dispatcher import FakeDiscordClient, FakeFeed
+from streamer.tests.test_eventfilter import FakeClassifier, FakeRepeatDB, fake_event
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0.0
+
+
+@pytest.mark.asyncio
+async def test_outcomes_are_counted():
+    before = {
+        outcome: sample("streamer_events_total", tag="metrics", outcome=outcome)
+        for outcome in ["match", "reject", "repeat"]
+    }
+    cases = [
+        (FakeClassifier(), FakeRepeatDB(False)),
+        (FakeClassifier(result="negative"), FakeRepeatDB(False)),
+        (FakeClassifier(), FakeRepeatDB(True)),
+    ]
+    for classifier, repeat_db in cases:
+        ef = EventFilter("metrics", [], classifier=classifier, repeat_db=repeat_db)
+        await ef.handle_event(fake_event())
+
+    for outcome in ["match", "reject", "repeat"]:
+        count = sample("streamer_events_total", tag="metrics", outcome=outcome)
+        assert count == before[outcome] + 1
+    assert sample("streamer_stage_seconds_count", stage="classifier", tag="metrics")
+
+
+@pytest.mark.asyncio
+async def test_dispatch_stages_and_gauges():
+    before = sample("streamer_stage_seconds_count", stage="dispatch", tag="test")
+    dispatcher = Dispatcher(FakeDiscordClient(), FakeFeed(3))
+    dispatcher.add_filter(EventFilter("test", [1]))
+    await dispatcher.monitor_feed()
+
+    after = sample("streamer_stage_seconds_count", stage="dispatch", tag="test")
+    assert after == before + 3
+    assert sample("streamer_stage_seconds_count", stage="send", tag="")
+    assert REGISTRY.get_sample_value("streamer_in_flight") == 0
+    assert REGISTRY.get_sample_value("streamer_queue_depth", {"queue": "dispatch"}) == 0
@@ -0,0 +1,56 @@
+from streamer.nearduplicate import NearDuplicateIndex, normalize
+
+
+def test_normalize():
+    assert normalize("Hello, @bob!  https://t.co/x World") == "hello world"
+
+
+def test_exact_copy():
+    index = NearDuplicateIndex()
+    assert index.check_and_add("OpenAI releases a new model https://t.co/a")[0] is None
+    kind, text, score = index.check_and_add(
+        "openai releases a new model https://t.co/b"
+    )
+    assert kind == "exact"
+    assert score == 1.0
+
+
+def test_near_copy():
+    index = NearDuplicateIndex()
+    index.add(
+        "DeepMind announces a new protein folding model that beats every baseline"
+    )
+    kind, _, score = index.check(
+        "BREAKING: DeepMind announces a new protein folding model that beats every baseline"
+    )
+    assert kind == "near"
+    assert score >= index.threshold
+
+
+def test_different_text():
+    index = NearDuplicateIndex()
+    index.add("DeepMind announces a new protein folding model")
+    assert index.check("The weather in Paris is lovely this time of year")[0] is None
+
+
+def test_window_eviction():
+    index = NearDuplicateIndex(window=2)
+    index.add("first tweet text")
+    index.add("second tweet text")
+    index.add("third tweet text")
+    assert len(index) == 2
+    assert index.check("first tweet text")[0] != "exact"
+    assert not index.buckets or all(index.buckets.values())
+
+
+def test_short_texts_not_indexed():
+    index = NearDuplicateIndex()
+    texts = [
+        "@bayeslord https://t.co/abc",
+        "🚀🚀 https://t.co/xyz",
+        "@someoneelse 🔥 https://t.co/qqq",
+    ]
+    for text in texts:
+        assert index.fingerprint(text) is None
+        assert index.check_and_add(text)[0] is None
+    assert len(index) == 0
@@ -0,0 +1,205 @@
+import asyncio
+
+import numpy as np
+import pytest
+from streamer import embeddings
+from streamer.repeatdb import RepeatDB
+from streamer.vectorindex import LocalIndex
+from streamer.workcontext import WorkContext
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def fake_embedding(text):
+    # deterministic unit vector per text
+    rng = np.random.default_rng(abs(hash(text)) % 2**32)
+    return rng.normal(size=1536).tolist()
+
+
+@pytest.fixture
+def stub_embeddings(monkeypatch):
+    async def get_embedding(text):
+        return fake_embedding(text)
+
+    monkeypatch.setattr(embeddings, "get_embedding", get_embedding)
+
+
+def test_local_index_nearest():
+    index = LocalIndex(dim=4, capacity=8)
+    assert index.get_nearest([1, 0, 0, 0]) == (None, None)
+    index.add("a", [1, 0, 0, 0])
+    index.add("b", [0, 1, 0, 0])
+    text, score = index.get_nearest([0.9, 0.1, 0, 0])
+    assert text == "a"
+    assert score == pytest.approx(0.9 / np.hypot(0.9, 0.1))
+
+
+def test_local_index_ring_eviction():
+    index = LocalIndex(dim=2, capacity=2)
+    index.add("a", [1, 0])
+    index.add("b", [0, 1])
+    index.add("c", [-1, 0])
+    assert len(index) == 2
+    assert index.get_nearest([1, 0])[0] != "a"
+
+
+def test_local_index_max_age():
+    clock = FakeClock()
+    index = LocalIndex(dim=2, capacity=4, max_age=60, clock=clock)
+    index.add("old", [1, 0])
+    clock.now += 61
+    assert index.get_nearest([1, 0]) == (None, None)
+
+
+def test_local_index_prune():
+    index = LocalIndex(dim=2, capacity=4)
+    index.add("old", [1, 0], timestamp=10)
+    index.add("new", [0.9, 0.1], timestamp=20)
+    assert index.get_nearest([1, 0], since=15)[0] == "new"
+    index.prune(15)
+    assert len(index) == 1
+    assert index.get_nearest([1, 0])[0] == "new"
+
+
+def test_local_index_snapshot(tmp_path):
+    path = str(tmp_path / "index.npz")
+    index = LocalIndex(dim=2, capacity=4, snapshot_path=path)
+    index.add("a", [1, 0])
+    index.add("b", [0, 1])
+    index.save(path)
+
+    restored = LocalIndex(dim=2, capacity=4, snapshot_path=path)
+    assert len(restored) == 2
+    assert restored.get_nearest([0, 1])[0] == "b"
+    restored.reset()
+    assert len(restored) == 0
+
+
+@pytest.mark.asyncio
+async def test_check_repeat(stub_embeddings):
+    repeat_db = RepeatDB("test", snapshot_path=None)
+    assert await repeat_db.check_repeat("some text") == (False, None, None)
+    matches, text, score = await repeat_db.check_repeat("some text")
+    assert matches
+    assert text == "some text"
+    matches, _, _ = await repeat_db.check_repeat("other text")
+    assert not matches
+    stats = repeat_db.stats()
+    assert stats["exact"] == 1
+    assert stats["embedded"] == 2
+    assert stats["embedding_avoided"] == 1 / 3
+
+
+@pytest.mark.asyncio
+async def test_link_only_tweets_are_embedded(stub_embeddings):
+    # these normalize to nothing, so only their embeddings can tell them apart
+    repeat_db = RepeatDB("test", snapshot_path=None)
+    for text in ["@bayeslord https://t.co/abc", "🚀🚀 https://t.co/xyz"]:
+        matches, _, _ = await repeat_db.check_repeat(text)
+        assert not matches
+    assert repeat_db.stats()["embedded"] == 2
+    assert len(repeat_db.prefilter) == 0
+
+
+@pytest.mark.asyncio
+async def test_check_repeat_before_flush(monkeypatch):
+    # different words, same meaning: only the embedding lookup can catch these
+    async def get_embedding(text):
+        return fake_embedding("same meaning")
+
+    monkeypatch.setattr(embeddings, "get_embedding", get_embedding)
+    repeat_db = RepeatDB("test", snapshot_path=None, flush_interval=60)
+    await repeat_db.check_repeat("the first phrasing")
+    assert len(repeat_db.db.backend) == 0
+    matches, _, _ = await repeat_db.check_repeat("another way of saying it")
+    assert matches
+
+    await repeat_db.db.flush()
+    assert len(repeat_db.db.backend) == 2
+    matches, _, _ = await repeat_db.check_repeat("a third wording entirely")
+    assert matches
+    assert repeat_db.stats()["semantic"] == 2
+
+
+@pytest.mark.asyncio
+async def test_retention(stub_embeddings):
+    repeat_db = RepeatDB("test", snapshot_path=None, retention=60)
+    old = fake_embedding("some text")
+    repeat_db.db.backend.add("some text", old, timestamp=0)
+    matches, _, _ = await repeat_db.check_repeat("some text")
+    assert not matches
+
+    await repeat_db.db.prune()
+    assert len(repeat_db.db.backend) == 0
+    await repeat_db.db.close()
+
+
+@pytest.mark.asyncio
+async def test_check_repeat_not_admitted(stub_embeddings):
+    repeat_db = RepeatDB("test", snapshot_path=None)
+    rejected = asyncio.get_running_loop().create_future()
+    rejected.set_result(False)
+    assert await repeat_db.check_repeat("some text", admit=rejected) == (
+        False,
+        None,
+        None,
+    )
+    assert len(repeat_db.prefilter) == 0
+    assert not repeat_db.db.pending
+    # never remembered, so not a repeat the second time either
+    matches, _, _ = await repeat_db.check_repeat("some text")
+    assert not matches
+
+
+@pytest.mark.asyncio
+async def test_embedding_shared_across_filters(monkeypatch):
+    calls = []
+
+    async def get_embedding(text):
+        calls.append(text)
+        return fake_embedding(text)
+
+    monkeypatch.setattr(embeddings, "get_embedding", get_embedding)
+    context = WorkContext()
+    for tag in ["ai", "whitepill"]:
+        repeat_db = RepeatDB(tag, snapshot_path=None)
+        matches, _, _ = await repeat_db.check_repeat("some text", context=context)
+        assert not matches
+        assert len(repeat_db.db.pending) == 1
+    assert calls == ["some text"]
+
+
+@pytest.mark.asyncio
+async def test_pending_copy_waits_for_admit(monkeypatch):
+    # same meaning, different words: only the pending embedding can catch it
+    async def get_embedding(text):
+        return fake_embedding("same meaning")
+
+    monkeypatch.setattr(embeddings, "get_embedding", get_embedding)
+    repeat_db = RepeatDB("test", snapshot_path=None)
+    loop = asyncio.get_running_loop()
+    first_admit = loop.create_future()
+    first = asyncio.create_task(
+        repeat_db.check_repeat("the first phrasing", admit=first_admit)
+    )
+    await asyncio.sleep(0)
+    admitted = loop.create_future()
+    admitted.set_result(True)
+    second = asyncio.create_task(
+        repeat_db.check_repeat("another way of saying it", admit=admitted)
+    )
+    await asyncio.sleep(0.01)
+    assert not second.done()
+
+    first_admit.set_result(True)
+    assert (await first)[0] is False
+    matches, text, _ = await second
+    assert matches
+    assert text == "the first phrasing"
+    assert not repeat_db.pending
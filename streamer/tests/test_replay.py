@@ -0,0 +1,42 @@
+import json
+
+import pytest
+from streamer import embeddings
+from streamer.recorder import Recorder, read_recording
+from streamer.replay import compare, replay, synthesize
+from streamer.twitterfeed import parse_payload
+
+
+def test_recorder_round_trip(tmp_path):
+    path = tmp_path / "recording.jsonl"
+    recorder = Recorder(path, clock=lambda: 12.5)
+    payload = {"data": {"id": "1", "text": "hi"}, "matching_rules": [{"tag": "ai"}]}
+    recorder.record(json.dumps(payload).encode())
+    recorder.close()
+
+    [(t, data)] = read_recording(path)
+    assert t == 12.5
+    event, tags = parse_payload(data)
+    assert event["url"] == "https://twitter.com/i/web/status/1"
+    assert tags == ["ai"]
+
+
+@pytest.mark.asyncio
+async def test_replay_report(monkeypatch):
+    # replay installs its own embedder, don't leak it into other tests
+    monkeypatch.setattr(embeddings, "_batcher", None)
+    records = synthesize(60)
+    report = await replay(
+        records,
+        classifier_latency=0.001,
+        embedding_latency=0.001,
+        store_latency=0,
+        send_latency=0,
+        channel_rate=(1000, 1.0),
+    )
+    assert report["events"] == 60
+    assert report["dispatched"] >= 60
+    for stage in ["classifier", "embedding_request", "dispatch", "end_to_end"]:
+        assert set(report["stages"][stage]) == {"p50", "p95", "p99", "max"}
+    assert report["peak_rss_mb"] > 0
+    assert len(compare(report, report)) > 10
@@ -0,0 +1,82 @@
+import pytest
+from streamer.sender import ChannelSender, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakeMessage:
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeChannel:
+    def __init__(self):
+        self.messages = []
+
+    async def send(self, content):
+        self.messages.append(content)
+        return FakeMessage(len(self.messages))
+
+
+class FakeMessageIndex:
+    def __init__(self):
+        self.entries = {}
+
+    def record(self, message_id, urls):
+        self.entries[message_id] = urls
+
+
+def test_token_bucket():
+    clock = FakeClock()
+    bucket = TokenBucket(5, 5.0, clock=clock)
+    for _ in range(5):
+        assert bucket.delay() == 0
+        bucket.take()
+    assert bucket.delay() == pytest.approx(1.0)
+    clock.now += 0.5
+    assert bucket.delay() == pytest.approx(0.5)
+    clock.now += 100
+    bucket.take()
+    # refills only up to capacity
+    assert bucket.tokens == pytest.approx(4)
+
+
+@pytest.mark.asyncio
+async def test_coalesces_within_max_length():
+    channel = FakeChannel()
+    messages = FakeMessageIndex()
+    sender = ChannelSender(channel, TokenBucket(1, 0.01), messages, max_length=100)
+    for i in range(10):
+        sender.send(f"{i:02d}".ljust(30, "x"), f"url{i}")
+    assert sender.qsize() == 10
+    await sender.drain()
+
+    # three 30 character tweets and two newlines fit in 100 characters, four don't
+    assert [len(m) for m in channel.messages] == [92, 92, 92, 30]
+    assert messages.entries[1] == ["url0", "url1", "url2"]
+    assert sum(messages.entries.values(), []) == [f"url{i}" for i in range(10)]
+    assert sender.qsize() == 0
+    assert len(sender.latencies) == 10
+
+
+@pytest.mark.asyncio
+async def test_send_failure_does_not_stop_queue():
+    class FlakyChannel(FakeChannel):
+        async def send(self, content):
+            if not self.messages and content == "boom":
+                self.messages.append(None)
+                raise RuntimeError("429")
+            return await super().send(content)
+
+    channel = FlakyChannel()
+    sender = ChannelSender(channel, TokenBucket(1, 0.01), max_length=4)
+    sender.send("boom", "url0")
+    sender.send("ok", "url1")
+    await sender.drain()
+    assert channel.messages[-1] == "ok"
@@ -0,0 +1,83 @@
+from streamer.tweetdb import MessageIndex, TweetDB, TweetWriter
+
+
+def test_writer_batches_and_ignores_duplicates(tmp_path):
+    path = str(tmp_path / "tweets.db")
+    writer = TweetWriter(path, flush_interval=60).start()
+    writer.add("some text", "https://twitter.com/i/web/status/1", "ai")
+    writer.add("some text", "https://twitter.com/i/web/status/1", "ai")
+    writer.add("other text", "https://twitter.com/i/web/status/2", "eacc")
+    writer.set_reaction("https://twitter.com/i/web/status/2", "✅")
+    writer.flush()
+
+    db = TweetDB(path)
+    rows = db.conn.execute(
+        "SELECT url, tag, reaction FROM tweets ORDER BY id"
+    ).fetchall()
+    assert rows == [
+        ("https://twitter.com/i/web/status/1", "ai", ""),
+        ("https://twitter.com/i/web/status/2", "eacc", "✅"),
+    ]
+    writer.close()
+
+
+def test_writer_flushes_on_close(tmp_path):
+    path = str(tmp_path / "tweets.db")
+    writer = TweetWriter(path, flush_interval=60).start()
+    writer.add("some text", "https://twitter.com/i/web/status/1", "ai")
+    writer.close()
+    assert TweetDB(path).conn.execute("SELECT count(*) FROM tweets").fetchone() == (1,)
+
+
+def test_message_index(tmp_path):
+    path = str(tmp_path / "tweets.db")
+    writer = TweetWriter(path).start()
+    index = MessageIndex(writer, path, max_entries=1)
+    index.record(1, ["https://twitter.com/i/web/status/1"])
+    index.record(2, ["https://twitter.com/i/web/status/2"])
+    writer.flush()
+    # 1 was evicted from memory and comes back from the messages table
+    assert index.lookup(1) == ["https://twitter.com/i/web/status/1"]
+    assert index.lookup(2) == ["https://twitter.com/i/web/status/2"]
+    assert index.lookup(3) == []
+    writer.close()
+
+
+def test_iter_annotated(tmp_path):
+    db = TweetDB(str(tmp_path / "tweets.db"))
+    db.add("one", "u1", "ai")
+    db.add("two", "u2", "ai")
+    db.add("three", "u3", "it's")
+    db.add("four", "u4", "ai")
+    db.set_reaction("u1", "✅")
+    db.set_reaction("u3", "✅")
+    db.set_reaction("u4", "❌")
+    rows = list(db.iter_annotated("ai", ["❌", "✅"]))
+    assert rows == [(1, "u1", "one", "ai", "✅"), (4, "u4", "four", "ai", "❌")]
+    assert db.get_annotated("it's", ["✅"]) == [["u3", "three", "it's", "✅"]]
+
+    state = db.annotation_state("ai", ["❌", "✅"])
+    db.set_reaction("u4", "✅")
+    assert db.annotation_state("ai", ["❌", "✅"]) != state
+
+
+def test_annotation_state_sees_swaps(tmp_path):
+    db = TweetDB(str(tmp_path / "tweets.db"))
+    for i in range(1, 5):
+        db.add(f"tweet {i}", f"u{i}", "ai")
+    db.set_reaction("u1", "✅")
+    db.set_reaction("u2", "❌")
+    db.set_reaction("u3", "✅")
+    reactions = ["❌", "✅"]
+
+    states = [db.annotation_state("ai", reactions)]
+    # same counts and max ids per reaction as before each time
+    db.set_reaction("u1", "❌")
+    db.set_reaction("u2", "✅")
+    states.append(db.annotation_state("ai", reactions))
+    db.set_reaction("u4", "✅")
+    db.set_reaction("u3", "")
+    db.set_reaction("u2", "")
+    db.set_reaction("u3", "✅")
+    states.append(db.annotation_state("ai", reactions))
+    assert len(set(states)) == 3
@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+import tweepy
+from streamer import twitterfeed
+from streamer.twitterfeed import TwitterFeed, diff_rules
+
+
+class FakeRules:
+    """Stands in for the stream rules endpoints, counting modification calls."""
+
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.next_id = 100
+        self.calls = []
+
+    async def get_rules(self):
+        return tweepy.Response(self.rules or None, {}, [], {})
+
+    async def delete_rules(self, ids):
+        self.calls.append(("delete", list(ids)))
+        self.rules = [rule for rule in self.rules if rule.id not in ids]
+
+    async def add_rules(self, rules):
+        self.calls.append(("add", list(rules)))
+        for rule in rules:
+            self.next_id += 1
+            self.rules.append(
+                tweepy.StreamRule(value=rule.value, tag=rule.tag, id=str(self.next_id))
+            )
+        return tweepy.Response(None, {}, [], {})
+
+
+def rule(value, tag, id=None):
+    return tweepy.StreamRule(value=value, tag=tag, id=id)
+
+
+@pytest.fixture
+def feed(monkeypatch):
+    monkeypatch.setattr(twitterfeed, "get_bearer_token", lambda: "token")
+    return TwitterFeed(tweetdb=object())
+
+
+def use_rules(monkeypatch, feed, rules):
+    fake = FakeRules(rules)
+    for name in ["get_rules", "delete_rules", "add_rules"]:
+        monkeypatch.setattr(feed, name, getattr(fake, name))
+    return fake
+
+
+def test_diff_rules():
+    existing = [rule("ai", "ai", "1"), rule("old", "old", "2"), rule("ai", "ai", "3")]
+    wanted = [rule("ai", "ai"), rule("new", "new"), rule("ai", "other")]
+    stale, missing = diff_rules(existing, wanted)
+    assert stale == ["2", "3"]
+    assert [(r.value, r.tag) for r in missing] == [("new", "new"), ("ai", "other")]
+
+
+@pytest.mark.asyncio
+async def test_unchanged_rules_are_not_modified(feed, monkeypatch):
+    fake = use_rules(
+        monkeypatch, feed, [rule("ai", "ai", "1"), rule("eacc", "eacc", "2")]
+    )
+    await feed.set_rules([rule("eacc", "eacc"), rule("ai", "ai")])
+    assert fake.calls == []
+
+
+@pytest.mark.asyncio
+async def test_changed_rules_take_one_call_each(feed, monkeypatch):
+    fake = use_rules(
+        monkeypatch,
+        feed,
+        [rule("ai", "ai", "1"), rule("old", "old", "2"), rule("gone", "gone", "3")],
+    )
+    await feed.set_rules([rule("ai", "ai"), rule("new", "new"), rule("ai2", "ai2")])
+    assert [call for call, _ in fake.calls] == ["delete", "add"]
+    assert sorted((r.value, r.tag) for r in fake.rules) == [
+        ("ai", "ai"),
+        ("ai2", "ai2"),
+        ("new", "new"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_rules_from_empty(feed, monkeypatch):
+    fake = use_rules(monkeypatch, feed, [])
+    await feed.set_rules([rule("ai", "ai")])
+    assert [call for call, _ in fake.calls] == ["add"]
+
+
+@pytest.mark.asyncio
+async def test_reconnect(feed, monkeypatch):
+    connects = []
+
+    async def connect(method, endpoint, params=None):
+        connects.append(endpoint)
+        await asyncio.sleep(100)
+
+    monkeypatch.setattr(feed, "_connect", connect)
+    # before the feed is iterated there's nothing to reconnect
+    await feed.reconnect()
+    assert feed.task is None
+    feed.__aiter__()
+    first = feed.task
+    await asyncio.sleep(0)
+    await feed.reconnect()
+    await asyncio.sleep(0)
+    assert first.cancelled()
+    assert not feed.task.done()
+    assert connects == ["search", "search"]
+    feed.task.cancel()
@@ -0,0 +1,120 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+from streamer.watchdog import Heartbeats, Supervisor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def fake_supervisor(clock, **kwargs):
+    async def sleep(seconds):
+        clock.now += seconds
+        # let the checks run alongside a recovery
+        await asyncio.sleep(0)
+
+    return Supervisor(Heartbeats(clock), sleep=sleep, **kwargs)
+
+
+def sample(name, stage):
+    return REGISTRY.get_sample_value(name, {"stage": stage}) or 0.0
+
+
+@pytest.mark.asyncio
+async def test_idle_stage_is_not_stalled():
+    clock = FakeClock()
+    supervisor = fake_supervisor(clock)
+    busy = False
+    supervisor.watch("send", 300, busy=lambda: busy)
+    supervisor.heartbeats.beat("send")
+    clock.now += 1000
+    assert supervisor.stalled_stages() == []
+    busy = True
+    assert supervisor.stalled_stages() == ["send"]
+    supervisor.heartbeats.beat("send")
+    assert supervisor.stalled_stages() == []
+
+
+@pytest.mark.asyncio
+async def test_stalled_stream_is_reconnected():
+    clock = FakeClock()
+    supervisor = fake_supervisor(clock, backoff=5.0)
+    heartbeats = supervisor.heartbeats
+    reconnects = []
+
+    async def reconnect():
+        reconnects.append(clock())
+        # the first reconnect doesn't help, the second one does
+        if len(reconnects) == 2:
+            heartbeats.beat("stream")
+
+    supervisor.watch("stream", 120, recover=reconnect)
+    heartbeats.beat("stream")
+    stalls = sample("streamer_stalls_total", "stream")
+    recoveries = sample("streamer_time_to_recover_seconds_count", "stream")
+
+    clock.now += 60
+    await supervisor.check()
+    assert reconnects == []
+
+    clock.now += 100
+    await supervisor.check()
+    await supervisor.recovering["stream"]
+    assert len(reconnects) == 2
+    assert supervisor.recovering == {}
+    # waited out the threshold, then backed off between 2.5 and 5 seconds
+    assert 122.5 <= reconnects[1] - reconnects[0] <= 125
+    assert supervisor.stalled == set()
+    assert sample("streamer_stalls_total", "stream") == stalls + 1
+    assert sample("streamer_time_to_recover_seconds_count", "stream") == recoveries + 1
+
+
+@pytest.mark.asyncio
+async def test_stage_without_recover_is_reported_once():
+    clock = FakeClock()
+    supervisor = fake_supervisor(clock)
+    supervisor.watch("dispatch", 300)
+    stalls = sample("streamer_stalls_total", "dispatch")
+    clock.now += 301
+    await supervisor.check()
+    await supervisor.check()
+    assert supervisor.stalled == {"dispatch"}
+    assert sample("streamer_stalls_total", "dispatch") == stalls + 1
+
+    supervisor.heartbeats.beat("dispatch")
+    await supervisor.check()
+    assert supervisor.stalled == set()
+
+
+@pytest.mark.asyncio
+async def test_other_stages_checked_during_recovery():
+    clock = FakeClock()
+    supervisor = fake_supervisor(clock)
+    reconnects = []
+
+    async def reconnect():
+        # twitter is down, reconnecting never helps
+        reconnects.append(clock())
+
+    supervisor.watch("stream", 120, recover=reconnect)
+    supervisor.watch("dispatch", 300)
+    stalls = sample("streamer_stalls_total", "dispatch")
+    clock.now += 301
+    await supervisor.check()
+    recovery = supervisor.recovering["stream"]
+    assert supervisor.stalled == {"stream", "dispatch"}
+    assert sample("streamer_stalls_total", "dispatch") == stalls + 1
+
+    # the next check doesn't start a second recovery
+    await supervisor.check()
+    assert supervisor.recovering["stream"] is recovery
+    supervisor.heartbeats.beat("dispatch")
+    await supervisor.check()
+    assert supervisor.stalled == {"stream"}
+    recovery.cancel()
@@ -0,0 +1,57 @@
+import asyncio
+
+import pytest
+from streamer.workcontext import WorkContext, WorkContexts
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_work_is_shared():
+    calls = []
+
+    async def embed(text):
+        calls.append(text)
+        await asyncio.sleep(0.01)
+        return [1.0, 0.0]
+
+    context = WorkContext()
+    results = await asyncio.gather(
+        *(context.get("embedding", embed, "some text") for _ in range(3))
+    )
+    assert results == [[1.0, 0.0]] * 3
+    assert calls == ["some text"]
+    assert await context.get("embedding", embed, "some text") == [1.0, 0.0]
+    assert calls == ["some text"]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_work():
+    async def embed(text):
+        await asyncio.sleep(0.01)
+        return [1.0]
+
+    context = WorkContext()
+    first = asyncio.create_task(context.get("embedding", embed, "text"))
+    second = asyncio.create_task(context.get("embedding", embed, "text"))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == [1.0]
+
+
+def test_contexts_expire():
+    clock = FakeClock()
+    contexts = WorkContexts(ttl=60, clock=clock)
+    first = contexts.get("1")
+    assert contexts.get("1") is first
+    clock.now += 30
+    contexts.get("2")
+    clock.now += 31
+    assert contexts.get("1") is not first
+    assert len(contexts) == 2
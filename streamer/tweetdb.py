@@ -1,38 +1,221 @@
+import atexit
+import collections
+import hashlib
+import queue
 import sqlite3
+import threading
+import time
+
 import glog as log
 
+from streamer import metrics
+
+
+def connect(path="tweets.db"):
+    """Opens the tweet database in WAL mode and creates the schema if needed."""
+    conn = sqlite3.connect(path)
+    # WAL lets readers run alongside the writer, and with it synchronous=NORMAL only
+    # syncs at checkpoints instead of on every commit.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS tweets (id INTEGER PRIMARY KEY, url TEXT UNIQUE, tweet TEXT, tag TEXT, reaction TEXT default '')"
+    )
+    # create index on url
+    conn.execute("CREATE INDEX IF NOT EXISTS url_index ON tweets (url)")
+    # annotated exports filter on both
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS tag_reaction_index ON tweets (tag, reaction)"
+    )
+    # discord message id -> the tweet urls it carries, for resolving reactions
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS messages (message_id INTEGER, url TEXT, PRIMARY KEY (message_id, url))"
+    )
+    # offline classifier scores, one set per model version (see classifier/rescore.py)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS scores (tweet_id INTEGER, tag TEXT, version TEXT, label TEXT, score REAL, PRIMARY KEY (tag, version, tweet_id))"
+    )
+    conn.commit()
+    return conn
+
+
+_INSERT = "INSERT OR IGNORE INTO tweets (url, tweet, tag) VALUES (?, ?, ?)"
+_SET_REACTION = "UPDATE tweets SET reaction=? WHERE url=?"
+_ADD_MESSAGE = "INSERT OR IGNORE INTO messages (message_id, url) VALUES (?, ?)"
+
 
 class TweetDB:
-    def __init__(self):
-        self.conn = sqlite3.connect("tweets.db")
-        self.conn.execute(
-            "CREATE TABLE IF NOT EXISTS tweets (id INTEGER PRIMARY KEY, url TEXT UNIQUE, tweet TEXT, tag TEXT, reaction TEXT default '')"
-        )
-        # create index on url
-        self.conn.execute("CREATE INDEX IF NOT EXISTS url_index ON tweets (url)")
-        self.conn.commit()
+    def __init__(self, path="tweets.db"):
+        self.conn = connect(path)
 
     def add(self, tweet, url, tag):
-        self.conn.execute(
-            "INSERT INTO tweets (url, tweet, tag) VALUES (?, ?, ?)", (url, tweet, tag)
-        )
+        self.conn.execute(_INSERT, (url, tweet, tag))
         self.conn.commit()
 
     def set_reaction(self, url, reaction):
         log.info("Setting reaction for %s to %s", url, reaction)
-        self.conn.execute("UPDATE tweets SET reaction=? WHERE url=?", (reaction, url))
+        self.conn.execute(_SET_REACTION, (reaction, url))
         self.conn.commit()
 
+    def iter_annotated(self, tag, reactions):
+        """Yields (id, url, tweet, tag, reaction) rows for tag that have one of
+        reactions, e.g. ["❌", "✅"], in insertion order."""
+        reactions = list(reactions)
+        placeholders = ", ".join("?" * len(reactions))
+        yield from self.conn.execute(
+            f"SELECT id, url, tweet, tag, reaction FROM tweets WHERE tag=? AND reaction IN ({placeholders}) ORDER BY id",
+            [tag, *reactions],
+        )
+
+    def annotation_state(self, tag, reactions):
+        """Returns a fingerprint of the annotated rows for tag: a hash of every (id,
+        reaction) pair, so it changes with any annotation, re-annotation or removal."""
+        reactions = list(reactions)
+        placeholders = ", ".join("?" * len(reactions))
+        digest = hashlib.sha256()
+        for id, reaction in self.conn.execute(
+            f"SELECT id, reaction FROM tweets WHERE tag=? AND reaction IN ({placeholders}) ORDER BY id",
+            [tag, *reactions],
+        ):
+            digest.update(f"{id}:{reaction};".encode())
+        return digest.hexdigest()
+
     def get_annotated(self, tag, reactions):
         # reactions is a list of reactions to filter on
         # e.g. ["❌", "✅"]
         # returns a list of (url, tweet, tag, reaction) tuples
         # e.g. [("https://twitter.com/elonmusk/status/123", "I love Tesla", "positive", "✅")]
-        tweets = []
-        for row in self.conn.execute(
-            "SELECT url, tweet, tag, reaction FROM tweets WHERE tag='%s' AND reaction IN %s"
-            % (tag, str(tuple(reactions)))
-        ):
-            tweets.append([row[0], row[1], row[2], row[3]])
+        return [list(row[1:]) for row in self.iter_annotated(tag, reactions)]
+
+
+class TweetWriter:
+    """TweetWriter takes TweetDB writes off the caller's thread.  Writes are queued and a
+    background thread that owns its own connection commits them in batches: once
+    batch_size writes are waiting or flush_interval seconds after the first one,
+    whichever comes first.  Each batch is one transaction, so a burst of tweets costs
+    one sync instead of one per row.  Duplicate urls are ignored."""
+
+    _STOP = object()
+
+    def __init__(self, path="tweets.db", batch_size=500, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name="tweet-writer", daemon=True
+            )
+            self.thread.start()
+            atexit.register(self.close)
+        return self
+
+    def add(self, tweet, url, tag):
+        self.queue.put((_INSERT, (url, tweet, tag)))
+
+    def set_reaction(self, url, reaction):
+        log.info("Setting reaction for %s to %s", url, reaction)
+        self.queue.put((_SET_REACTION, (reaction, url)))
+
+    def add_message(self, message_id, url):
+        self.queue.put((_ADD_MESSAGE, (message_id, url)))
+
+    def flush(self):
+        """Blocks until everything queued so far is committed."""
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def close(self):
+        """Commits everything queued and stops the writer thread."""
+        if self.thread is not None:
+            self.queue.put(self._STOP)
+            self.thread.join()
+            self.thread = None
+
+    def _collect(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size and isinstance(batch[-1], tuple):
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, conn, writes):
+        # executemany over runs of the same statement, all in one transaction
+        try:
+            with metrics.timed("sqlite_write"), conn:
+                start = 0
+                while start < len(writes):
+                    end = start
+                    while end < len(writes) and writes[end][0] == writes[start][0]:
+                        end += 1
+                    conn.executemany(
+                        writes[start][0], [params for _, params in writes[start:end]]
+                    )
+                    start = end
+        except sqlite3.Error as e:
+            log.error(f"Failed to write {len(writes)} tweet db updates: {e}")
+
+    def _run(self):
+        conn = connect(self.path)
+        while True:
+            batch = self._collect()
+            writes = [item for item in batch if isinstance(item, tuple)]
+            if writes:
+                self._write(conn, writes)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if batch[-1] is self._STOP:
+                conn.close()
+                return
+
+
+class MessageIndex:
+    """MessageIndex maps the ids of messages we sent to the tweet urls in them, so a
+    reaction can be resolved without fetching the message from Discord.  The most
+    recent max_entries messages are kept in memory, older ones are looked up in the
+    messages table.  Writes go through writer."""
+
+    def __init__(self, writer, path="tweets.db", max_entries=10000):
+        self.writer = writer
+        self.conn = connect(path)
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    def _remember(self, message_id, urls):
+        self.entries[message_id] = urls
+        self.entries.move_to_end(message_id)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def record(self, message_id, urls):
+        self._remember(message_id, list(urls))
+        for url in urls:
+            self.writer.add_message(message_id, url)
 
-        return tweets
+    def lookup(self, message_id):
+        """Returns the tweet urls in a message, or an empty list if it isn't known."""
+        urls = self.entries.get(message_id)
+        if urls is not None:
+            self.entries.move_to_end(message_id)
+            return urls
+        urls = [
+            row[0]
+            for row in self.conn.execute(
+                "SELECT url FROM messages WHERE message_id=? ORDER BY rowid",
+                (message_id,),
+            )
+        ]
+        if urls:
+            self._remember(message_id, urls)
+        return urls
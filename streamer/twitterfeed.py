@@ -2,12 +2,15 @@
 import asyncio
 import functools
 import json
+import time
 
 import tweepy
 import tweepy.asynchronous
 import glog as log
 
-from streamer.tweetdb import TweetDB
+from streamer import metrics, watchdog
+from streamer.recorder import Recorder
+from streamer.tweetdb import TweetWriter
 
 
 @functools.lru_cache(maxsize=None)
@@ -26,32 +29,72 @@ def get_api(bearer_token):
     return api
 
 
+def diff_rules(existing, wanted):
+    """Returns the ids of the existing rules that aren't wanted (or are duplicates),
+    and the wanted rules that don't exist yet."""
+    have = set()
+    stale = []
+    wanted_keys = {(rule.value, rule.tag) for rule in wanted}
+    for rule in existing:
+        key = (rule.value, rule.tag)
+        if key not in wanted_keys or key in have:
+            stale.append(rule.id)
+        have.add(key)
+    missing = []
+    for rule in wanted:
+        key = (rule.value, rule.tag)
+        if key not in have:
+            missing.append(rule)
+            have.add(key)
+    return stale, missing
+
+
+def parse_payload(data):
+    """Returns the event for a raw stream payload and the tags of the rules it
+    matched.  Raises KeyError if the payload isn't a matched tweet.  The event is
+    stamped with the perf_counter time it was received."""
+    data = json.loads(data)
+    rules = data["matching_rules"]
+    id = data["data"]["id"]
+    event = {
+        "received": time.perf_counter(),
+        "id": id,
+        "text": data["data"]["text"],
+        "url": f"https://twitter.com/i/web/status/{id}",
+    }
+    return event, [rule["tag"] for rule in rules]
+
+
 class TwitterFeed(tweepy.asynchronous.AsyncStreamingClient):
-    def __init__(self, **kwargs):
+    def __init__(self, tweetdb=None, queue_size=1000, record_path=None, **kwargs):
+        """If record_path is set, every raw payload is appended to it for replaying
+        with streamer.replay."""
         self.bearer_token = get_bearer_token()
         super().__init__(self.bearer_token, **kwargs)
         self.started = False
-        self.queue = asyncio.Queue()
+        # bounded, so when dispatching falls behind on_data blocks and the stream
+        # reader stops pulling tweets instead of buffering without limit
+        self.queue = asyncio.Queue(queue_size)
         self.api = get_api(self.bearer_token)
-        self.tweetdb = TweetDB()
+        self.tweetdb = tweetdb or TweetWriter().start()
+        self.recorder = Recorder(record_path) if record_path else None
 
     async def set_rules(self, new_rules):
+        """Makes the stream rules match new_rules.  Rules are compared on value and tag
+        and only the difference is changed, with at most one delete and one add call,
+        because modifying filter rules is aggressively rate limited."""
         log.info(f"Setting rules to {new_rules}.")
-        # TODO this should merge the two sets of rules
-        # because modifying filter rules is aggressively rate limited
-
-        # get the existing rules
-        log.info(f"Getting existing rules.")
         rules = await self.get_rules()
-        if rules.data:
-            for rule in rules.data:
-                log.info(f"Deleting rule {rule.id} {rule.tag} {rule.value}.")
-                await self.delete_rules(rule.id)
-        # add the new rules
-        for rule in new_rules:
-            log.info(f"Adding rule {rule.tag} {rule.value}.")
-            await self.add_rules(rule)
-        log.info(f"Done setting rules.")
+        stale, missing = diff_rules(rules.data or [], new_rules)
+        if stale:
+            log.info(f"Deleting rules {stale}.")
+            await self.delete_rules(stale)
+        if missing:
+            log.info(f"Adding rules {missing}.")
+            response = await self.add_rules(missing)
+            for error in response.errors or []:
+                log.error(f"Failed to add rule: {error}")
+        log.info(f"Done setting rules, {len(stale)} deleted and {len(missing)} added.")
 
     def __aiter__(self):
         if not self.started:
@@ -86,33 +129,39 @@ class TwitterFeed(tweepy.asynchronous.AsyncStreamingClient):
         log.info("Timeout from Twitter")
         return True  # Don't kill the stream
 
+    async def on_keep_alive(self):
+        watchdog.beat("stream")
+
+    async def reconnect(self):
+        """Drops the stream connection, if any, and opens a new one.  Does nothing if
+        the stream hasn't been started yet, iterating the feed will connect it."""
+        if not self.started:
+            log.info("Stream not started yet, nothing to reconnect")
+            return
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+        log.info("Reconnecting to Twitter streaming API")
+        self.filter()
+
     async def on_data(self, data):
-        data = json.loads(data)
+        watchdog.beat("stream")
+        if self.recorder is not None:
+            self.recorder.record(data)
         try:
-            rules = data["matching_rules"]
-            id = data["data"]["id"]
-            text = data["data"]["text"]
-            url = f"https://twitter.com/i/web/status/{id}"
+            with metrics.timed("decode"):
+                event, tags = parse_payload(data)
         except KeyError as e:
             log.warn(f"Error reading stream content: {e}")
             return
 
-        event = {
-            "id": id,
-            "text": text,
-            "url": url,
-        }
-        for tag in rules:
-            await self.queue.put((event, tag["tag"]))
+        for tag in tags:
+            await self.queue.put((event, tag))
             qsize = self.get_qsize()
             if qsize > 10:
-                log.info(f"[{tag['tag']}] queued tweet {id} (qsize: {qsize})")
+                log.info(f"[{tag}] queued tweet {event['id']} (qsize: {qsize})")
 
-        # save the first tag in rules, along with the url and the full text
-        tag = rules[0]["tag"]
-        try:
-            self.tweetdb.add(text, url, tag)
-        except sqlite3.IntegrityError as e:
-            # it's apparently not safe to assume that these are unique from the feed.
-            log.warn(f"Error saving tweet {id}: {e}")
-            return
+        # save the first tag in rules, along with the url and the full text.
+        # it's apparently not safe to assume that these are unique from the feed,
+        # the writer ignores duplicate urls.
+        self.tweetdb.add(event["text"], event["url"], tags[0])
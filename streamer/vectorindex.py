@@ -0,0 +1,137 @@
+# in-process vector index for nearest-neighbour lookups over recent tweets.
+
+import os
+import time
+
+import glog as log
+import numpy as np
+
+
+class LocalIndex:
+    """LocalIndex keeps up to capacity embeddings in a preallocated float32 matrix with
+    unit-length rows, so a cosine top-1 lookup is a single matrix-vector product.  Once
+    full, the oldest row is overwritten.  Rows older than max_age seconds are ignored by
+    lookups.  If snapshot_path is set the index is restored from it on startup and
+    written back every snapshot_interval seconds."""
+
+    def __init__(
+        self,
+        dim=1536,
+        capacity=20000,
+        max_age=None,
+        snapshot_path=None,
+        snapshot_interval=300,
+        clock=time.time,
+    ):
+        self.dim = dim
+        self.capacity = capacity
+        self.max_age = max_age
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.clock = clock
+        self._allocate()
+        if snapshot_path and os.path.exists(snapshot_path):
+            self.load(snapshot_path)
+        self.last_snapshot = self.clock()
+
+    def __len__(self):
+        return self.count
+
+    def _allocate(self):
+        self.vectors = np.zeros((self.capacity, self.dim), dtype=np.float32)
+        self.timestamps = np.zeros(self.capacity, dtype=np.float64)
+        self.texts = [None] * self.capacity
+        self.next = 0  # row the next add writes to
+        self.count = 0
+
+    def reset(self):
+        """Drops every row, including the snapshot on disk."""
+        self._allocate()
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            os.remove(self.snapshot_path)
+
+    def add(self, text, embedding, timestamp=None):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector = vector / norm
+        self.vectors[self.next] = vector
+        self.timestamps[self.next] = self.clock() if timestamp is None else timestamp
+        self.texts[self.next] = text
+        self.next = (self.next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.maybe_snapshot()
+
+    def add_batch(self, items):
+        """Adds (text, embedding, timestamp) items."""
+        for text, embedding, timestamp in items:
+            self.add(text, embedding, timestamp)
+
+    def get_nearest(self, embedding, since=None):
+        """Returns the text and cosine similarity of the closest row added at or after
+        since, or (None, None)."""
+        if self.count == 0:
+            return None, None
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if norm > 0:
+            query = query / norm
+        scores = self.vectors[: self.count] @ query
+        if self.max_age is not None:
+            cutoff = self.clock() - self.max_age
+            since = cutoff if since is None else max(since, cutoff)
+        if since is not None:
+            scores[self.timestamps[: self.count] < since] = -np.inf
+        best = int(np.argmax(scores))
+        if not np.isfinite(scores[best]):
+            return None, None
+        return self.texts[best], float(scores[best])
+
+    def prune(self, older_than):
+        """Drops rows added before the older_than timestamp."""
+        keep = np.flatnonzero(self.timestamps[: self.count] >= older_than)
+        if len(keep) == self.count:
+            return
+        # compact the surviving rows to the front, oldest first
+        keep = keep[np.argsort(self.timestamps[keep], kind="stable")]
+        count = len(keep)
+        self.vectors[:count] = self.vectors[keep]
+        self.timestamps[:count] = self.timestamps[keep]
+        self.texts[:count] = [self.texts[i] for i in keep]
+        self.texts[count : self.count] = [None] * (self.count - count)
+        self.count = count
+        self.next = count % self.capacity
+
+    def maybe_snapshot(self):
+        if not self.snapshot_path:
+            return
+        if self.clock() - self.last_snapshot >= self.snapshot_interval:
+            self.save(self.snapshot_path)
+
+    def save(self, path):
+        # write to a temporary file first so a crash never leaves a torn snapshot
+        tmp = f"{path}.tmp.npz"
+        np.savez(
+            tmp,
+            vectors=self.vectors[: self.count],
+            timestamps=self.timestamps[: self.count],
+            texts=np.array(["" if t is None else t for t in self.texts[: self.count]]),
+        )
+        os.replace(tmp, path)
+        self.last_snapshot = self.clock()
+
+    def load(self, path):
+        with np.load(path) as snapshot:
+            vectors = snapshot["vectors"]
+            if vectors.shape[1] != self.dim:
+                log.warn(f"Ignoring snapshot {path}: dimension {vectors.shape[1]}")
+                return
+            # keep the most recent rows if the capacity shrank since the snapshot
+            order = np.argsort(snapshot["timestamps"], kind="stable")[-self.capacity :]
+            count = len(order)
+            self.vectors[:count] = vectors[order]
+            self.timestamps[:count] = snapshot["timestamps"][order]
+            self.texts[:count] = [str(t) for t in snapshot["texts"][order]]
+        self.count = count
+        self.next = count % self.capacity
+        log.info(f"Restored {count} vectors from {path}")
@@ -0,0 +1,120 @@
+# stage heartbeats and a supervisor that notices and recovers from stalls.
+
+import asyncio
+import random
+import time
+
+import glog as log
+
+from . import metrics
+
+
+class Heartbeats:
+    """Heartbeats remembers when each stage last made progress."""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.started = clock()
+        self.last = {}
+
+    def beat(self, stage):
+        self.last[stage] = self.clock()
+
+    def age(self, stage):
+        """Seconds since stage last beat, or since we started if it never has."""
+        return self.clock() - self.last.get(stage, self.started)
+
+
+# the stages beat this one: "stream" for every payload and keep-alive, "dispatch"
+# for every dispatched event and "send" for every message sent.
+heartbeats = Heartbeats()
+
+
+def beat(stage):
+    heartbeats.beat(stage)
+
+
+class Supervisor:
+    """Supervisor checks every interval seconds that each watched stage has beaten
+    within its threshold.  Stages with a busy callable only count as stalled while it
+    returns True, so an idle stage isn't a stalled one.  A stalled stage with a recover
+    coroutine function (e.g. TwitterFeed.reconnect) is recovered in process: recover
+    is called, and if the stage doesn't beat within its threshold it's called again
+    after a jittered exponential backoff, until it does.  Each recovery runs as its
+    own task, at most one per stage, so the other stages are still checked while it
+    goes on.  Stages without one are logged and counted."""
+
+    def __init__(
+        self,
+        heartbeats=heartbeats,
+        interval=10.0,
+        backoff=5.0,
+        max_backoff=300.0,
+        sleep=asyncio.sleep,
+    ):
+        self.heartbeats = heartbeats
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.watched = {}  # stage -> (threshold, recover, busy)
+        self.stalled = set()
+        self.recovering = {}  # stage -> recovery task
+
+    def watch(self, stage, threshold, recover=None, busy=None):
+        self.watched[stage] = (threshold, recover, busy)
+
+    def stalled_stages(self):
+        return [
+            stage
+            for stage, (threshold, _, busy) in self.watched.items()
+            if self.heartbeats.age(stage) > threshold and (busy is None or busy())
+        ]
+
+    async def run(self):
+        while True:
+            await self.sleep(self.interval)
+            await self.check()
+
+    async def check(self):
+        stalled = self.stalled_stages()
+        for stage in stalled:
+            threshold, recover, _ = self.watched[stage]
+            age = self.heartbeats.age(stage)
+            if stage not in self.stalled:
+                log.warn(f"{stage} stalled, no progress for {age:.0f}s")
+                metrics.STALLS.labels(stage).inc()
+            self.stalled.add(stage)
+            if recover is not None and stage not in self.recovering:
+                task = asyncio.create_task(self.recover(stage, threshold, recover))
+                self.recovering[stage] = task
+                task.add_done_callback(
+                    lambda _, stage=stage: self.recovering.pop(stage, None)
+                )
+        for stage in self.stalled - set(stalled):
+            log.info(f"{stage} is making progress again")
+            self.stalled.discard(stage)
+
+    async def recover(self, stage, threshold, recover):
+        clock = self.heartbeats.clock
+        stalled_since = clock() - self.heartbeats.age(stage)
+        attempt = 0
+        while True:
+            log.warn(f"recovering {stage}, attempt {attempt + 1}")
+            metrics.RECOVERY_ATTEMPTS.labels(stage).inc()
+            started = clock()
+            try:
+                await recover()
+            except Exception as e:
+                log.error(f"failed to recover {stage}: {e!r}")
+            while clock() - started < threshold:
+                if self.heartbeats.last.get(stage, started - 1) >= started:
+                    recovered = self.heartbeats.last[stage] - stalled_since
+                    log.info(f"{stage} recovered after {recovered:.0f}s")
+                    metrics.TIME_TO_RECOVER.labels(stage).observe(recovered)
+                    self.stalled.discard(stage)
+                    return
+                await self.sleep(min(1.0, threshold))
+            delay = min(self.max_backoff, self.backoff * 2 ** min(attempt, 16))
+            await self.sleep(random.uniform(delay / 2, delay))
+            attempt += 1
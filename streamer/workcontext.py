@@ -0,0 +1,44 @@
+# work shared by every filter handling the same tweet.
+
+import asyncio
+import collections
+import time
+
+
+class WorkContext:
+    """WorkContext memoizes tag-independent work for one tweet, like its embedding.
+    The first caller for a key starts the work, every caller awaits the same result.
+    The work isn't cancelled when one caller is, the others may still want it."""
+
+    def __init__(self):
+        self.results = {}
+
+    async def get(self, key, fn, *args):
+        """Returns the result of fn(*args), awaiting it only once per key."""
+        if key not in self.results:
+            self.results[key] = asyncio.ensure_future(fn(*args))
+        return await asyncio.shield(self.results[key])
+
+
+class WorkContexts:
+    """WorkContexts hands out a WorkContext per tweet id and forgets it ttl seconds
+    after it was created, by which time every filter has handled the tweet."""
+
+    def __init__(self, ttl=60.0, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.contexts = collections.OrderedDict()  # id -> (created, context)
+
+    def __len__(self):
+        return len(self.contexts)
+
+    def get(self, id):
+        now = self.clock()
+        while self.contexts:
+            created, _ = next(iter(self.contexts.values()))
+            if created > now - self.ttl:
+                break
+            self.contexts.popitem(last=False)
+        if id not in self.contexts:
+            self.contexts[id] = (now, WorkContext())
+        return self.contexts[id][1]